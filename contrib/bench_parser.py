@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# Micro-benchmark of the reply parser
+#
+# Compares the table driven parse_lines() with the previous parser (string concatenation per byte, split, dict of lists and
+# per-call parser map), which is kept here for reference only.
+
+import sys
+import timeit
+
+from digidog import parse_lines
+
+# Reply to "VCS" as sent by the firmware
+REPLY = (b"V:2\r\nU:1\r\nO:10000002\r\n"
+         b"T:1200\r\nS:1200\r\nK:18000\r\nM:0\r\nN:0\r\nH:0,2,1\r\nI:0,1 0,1\r\nZ:5000,2000,1000\r\nR:1000\r\n"
+         b"C:1187\r\nS:1200\r\nA:1\r\nF:0\r\nJ:0\r\nL:0\r\n#:3\r\n")
+
+LEGACY_ARGMAP = {
+    "A": "timer.armed", "C": "timer.current", "F": "timer.fired", "H": "device.pinout",
+    "I": "device.output-levels", "J": "timer.locked", "K": "device.internal-watchdog",
+    "L": "timer.fired.lifetime", "M": "target.recovery-method.firmware",
+    "N": "target.recovery-method", "O": "device.serial", "P": "command.executed",
+    "Q": "command.blocked", "R": "target.reset-timings", "S": "timer.start",
+    "T": "timer.start.firmware", "U": "device.unit-id", "V": "device.version",
+    "W": "debug.method", "X": "command.not-implemented", "Z": "target.power-timings",
+}
+
+
+def legacy_single(convert):
+    return lambda items: [convert(item) for item in items][0]
+
+
+def legacy_power_timings(items):
+    press1, pause, press2 = items[0].split(",")
+    return {"press1": press1, "pause": pause, "press2": press2}
+
+
+def legacy_output_levels(items):
+    reset, power = items[0].split(" ")
+    reset_on, reset_off = reset.split(",")
+    power_on, power_off = power.split(",")
+    level = lambda value: "HIGH" if int(value) else "LOW"
+    return {"reset": {"on": level(reset_on), "off": level(reset_off)},
+            "power": {"on": level(power_on), "off": level(power_off)}}
+
+
+def legacy_pinout(items):
+    reset, power, led = items[0].split(",")
+    return {"reset": reset, "power": power, "led": led}
+
+
+def legacy_parse(data):
+    """The parser as it was before the table driven one."""
+    text = ""
+    for index in range(len(data)):
+        text = text + data[index:index + 1].decode("ascii")
+    commands = {}
+    for line in [x for x in text.split("\n") if x != ""]:
+        try:
+            key, value = line.split(":", 1)
+        except ValueError:
+            key = "unknown"
+            value = line
+        if key not in commands:
+            commands[key] = []
+        commands[key].append(value.strip())
+    parser_map = {
+        "target.power-timings": legacy_power_timings,
+        "target.reset-timings": legacy_single(int),
+        "device.internal-watchdog": legacy_single(int),
+        "target.recovery-method": legacy_single(lambda item: "power" if item else "reset"),
+        "target.recovery-method.firmware": legacy_single(lambda item: "power" if item else "reset"),
+        "device.pinout": legacy_pinout,
+        "device.output-levels": legacy_output_levels,
+        "timer.armed": legacy_single(lambda item: bool(int(item))),
+        "timer.fired": legacy_single(lambda item: bool(int(item))),
+        "timer.fired.lifetime": legacy_single(int),
+        "timer.locked": legacy_single(lambda item: bool(int(item))),
+        "timer.start": legacy_single(int),
+        "timer.start.firmware": legacy_single(int),
+        "timer.current": legacy_single(int),
+    }
+    parsed = {}
+    for char, items in commands.items():
+        if char in LEGACY_ARGMAP:
+            name = LEGACY_ARGMAP[char]
+            if name in parser_map:
+                items = parser_map[name](items)
+            parsed[name] = items
+        else:
+            parsed.setdefault("unknown", {})[char] = items
+    return parsed
+
+
+def table_parse(data):
+    return parse_lines(data.splitlines())
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 20000
+    for name, function in (("legacy", legacy_parse), ("table", table_parse)):
+        seconds = min(timeit.repeat(lambda: function(REPLY), number=number, repeat=3))
+        print("{:8} {:8.2f} us per reply".format(name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,10 @@
+# Python client for DigiDog USB watchdogs speaking SLCPv1
+#
+# Importing the package has no side effects and does not import pyserial;
+# the asyncio client, daemon, metrics and tools are separate modules.
+
+from .client import CapabilityCache, DigiDog, KeepaliveScheduler
+from .protocol import (FIELDS, CommandBlocked, CommandNotSensibleInThisState, ConfigMismatch,
+                       LineSplitter, VersionMismatch, parse_lines)
+
+WDT_DEVICE = "/dev/ttyACM0"
@@ -0,0 +1,590 @@
+# asyncio client for DigiDog devices
+
+import asyncio
+import collections
+import sys
+from time import monotonic
+
+import serial
+
+from .client import CapabilityCache, DigiDog, KeepaliveScheduler, LineCounter, _port_errors
+from .events import AsyncStatusWatcher
+from .protocol import (CommandBlocked, CommandNotSensibleInThisState, LineSplitter,
+                       VersionMismatch, parse_lines)
+
+
+class AsyncSerialPort(object):
+    """Serial port read through the event loop instead of blocking reads.
+       Received data is split into lines as it arrives; at most MAX_LINES
+       (or REPLY_LINES per reply expected) are kept, older ones are dropped
+       if nobody reads them. 'transport' opens the port instead of
+       open_serial(), see DigiDog."""
+
+    MAX_LINES = 64
+    # Lines of the longest reply ('<')
+    REPLY_LINES = 20
+
+    def __init__(self, device, timeout=.2, transport=None):
+        self._device = device
+        self._timeout = timeout
+        self._transport = transport or AsyncSerialPort.open_serial
+        self._sdev = None
+        self._splitter = LineSplitter()
+        self._lines = collections.deque(maxlen=AsyncSerialPort.MAX_LINES)
+        self._error = None
+        self._waiter = None
+
+    @property
+    def is_open(self):
+        return self._sdev is not None
+
+    @staticmethod
+    def open_serial(device):
+        """Open the serial port of a device for reads that do not block."""
+        return serial.Serial(device, 9600, xonxoff=False, rtscts=False, timeout=0)
+
+    def open(self):
+        """Open the port and start watching it for data."""
+        self._sdev = self._transport(self._device)
+        self.reset_input_buffer()
+        self._error = None
+        asyncio.get_event_loop().add_reader(self._sdev.fileno(), self._on_readable)
+
+    def close(self):
+        """Stop watching the port and close it."""
+        if self._sdev is not None:
+            try:
+                asyncio.get_event_loop().remove_reader(self._sdev.fileno())
+                self._sdev.close()
+            except (serial.SerialException, OSError, ValueError):
+                pass
+            finally:
+                self._sdev = None
+
+    def _on_readable(self):
+        try:
+            self._lines.extend(self._splitter.feed(self._sdev.read(self._sdev.in_waiting or 1)))
+        except (serial.SerialException, OSError) as e:
+            # The device is gone. Stop watching, the next read raises.
+            self._error = e
+            asyncio.get_event_loop().remove_reader(self._sdev.fileno())
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def reset_input_buffer(self, replies=1):
+        """Drop what was received, including what the OS still buffers (as
+           pyserial's reset_input_buffer() does for DigiDog), and make room
+           for the lines of 'replies'."""
+        if self._sdev is not None:
+            try:
+                self._sdev.reset_input_buffer()
+            except _port_errors() as e:
+                # termios.error is no OSError, but is handled like one.
+                raise OSError(*e.args)
+        self._splitter.flush()
+        self._lines = collections.deque(maxlen=max(AsyncSerialPort.MAX_LINES, replies * AsyncSerialPort.REPLY_LINES))
+
+    def take_counts(self):
+        """Return and reset the numbers of dropped and malformed lines, see
+           LineSplitter."""
+        counts = self._splitter.dropped, self._splitter.malformed
+        self._splitter.dropped = self._splitter.malformed = 0
+        return counts
+
+    def write(self, data):
+        self._sdev.write(data)
+
+    async def readline(self):
+        """Return the next non-empty line without its line end. If no data
+           arrives for 'timeout', whatever was received is returned, which is
+           b"" if nothing was."""
+        while True:
+            if self._error is not None:
+                raise serial.SerialException(self._error)
+            if self._lines:
+                return self._lines.popleft()
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await asyncio.wait_for(self._waiter, self._timeout)
+            except asyncio.TimeoutError:
+                return self._splitter.flush()
+            finally:
+                self._waiter = None
+
+
+class AsyncDigiDog(CapabilityCache, LineCounter):
+    """Abstraction of DigiDog device for asyncio. The methods match the ones
+       of DigiDog but are coroutines. The port is kept open like in a session
+       of DigiDog and reopened once if an exchange fails. 'transport' is
+       passed to AsyncSerialPort, e.g. a digidog.capture.Recorder of
+       AsyncSerialPort.open_serial to record the traffic."""
+
+    # Upper limit for a whole exchange, so a device that keeps sending does
+    # not hold up its caller.
+    COMMAND_TIMEOUT = 2.0
+
+    def __init__(self, device, metrics=None, transport=None):
+        self._device = device
+        self._transport = transport
+        self._port = AsyncSerialPort(device, transport=transport)
+        self._lock = None
+        self.metrics = metrics
+        # Times the port was opened again after an exchange failed
+        self.reconnects = 0
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def device(self):
+        return self._device
+
+    def open(self):
+        """Open the port of the device."""
+        if not self._port.is_open:
+            self._port.open()
+            self.invalidate_capabilities()
+
+    def close(self):
+        """Close the port of the device."""
+        self._port.close()
+
+    def move(self, device):
+        """Use another port from now on, e.g. after the device was enumerated
+           under another name. 'metrics' is told to move what it keeps by port."""
+        self.close()
+        if self.metrics is not None:
+            self.metrics.observe_move(self._device, device)
+        self._device = device
+        self._port = AsyncSerialPort(device, transport=self._transport)
+
+    async def _exchange_batch(self, write, ends):
+        """Send 'write' and split the reply, see DigiDog._exchange_batch().
+           Raise asyncio.TimeoutError if a reply with a known final line is
+           cut short by a read timeout."""
+        self._port.reset_input_buffer(len(ends))
+        self._port.write(write.encode("ascii"))
+        replies = [[] for end in ends]
+        index = 0
+        while index < len(ends):
+            line = await self._port.readline()
+            if not line:
+                if ends[index] is not None:
+                    raise asyncio.TimeoutError("Reply {} of {} to '{}' is incomplete".format(index + 1, len(ends), write))
+                break
+            replies[index].append(line)
+            if ends[index] is not None and line.startswith(ends[index]):
+                index += 1
+        return replies
+
+    async def _communicate(self, write, ends):
+        """Exchange 'write' with the device, one exchange at a time."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                self.open()
+                return await asyncio.wait_for(self._exchange_batch(write, ends), self.COMMAND_TIMEOUT)
+            except asyncio.TimeoutError:
+                # A device that does not answer is left to the caller (see
+                # digidog.recovery). From Python 3.11 on, asyncio.TimeoutError
+                # is an OSError, so it has to be caught before those.
+                raise
+            except (serial.SerialException, OSError):
+                # If this fails as well, the port stays closed and the next
+                # command tries to open it again.
+                self.reconnects += 1
+                if self.metrics is not None:
+                    self.metrics.observe_reconnect(self._device)
+                self.close()
+                self.open()
+                return await asyncio.wait_for(self._exchange_batch(write, ends), self.COMMAND_TIMEOUT)
+            finally:
+                self._count_lines(*self._port.take_counts())
+
+    async def _exchange_observed(self, write, commands):
+        """Exchange 'write' for the replies to 'commands'. A timeout is
+           reported to 'metrics' before it is raised, as no replies are left
+           to pass to observe_exchange()."""
+        try:
+            return await self._communicate(write, DigiDog._batch_ends(commands))
+        except asyncio.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.observe_timeout(self._device, commands)
+            raise
+
+    async def command(self, command):
+        """Send command to device, return results as dict of lists."""
+        return (await self._command(command))[1]
+
+    async def _command(self, command):
+        """Send command to device, return the reply lines and the results."""
+        started = monotonic()
+        replies = await self._exchange_observed(command, [command])
+        results = parse_lines(replies[0])
+        self._update_capabilities(command, results)
+        if self.metrics is not None:
+            self.metrics.observe_exchange(self._device, [command], replies, monotonic() - started)
+            self.metrics.observe_results(self._device, results)
+        return replies[0], results
+
+    async def batch(self, commands):
+        """Send several commands in one write, see DigiDog.batch()."""
+        commands = list(commands)
+        if not commands:
+            return []
+        started = monotonic()
+        replies = await self._exchange_observed("".join(commands), commands)
+        if self.metrics is not None:
+            self.metrics.observe_exchange(self._device, commands, replies, monotonic() - started)
+        batch_results = []
+        for command, lines in zip(commands, replies):
+            results = parse_lines(lines)
+            self._update_capabilities(command, results)
+            if self.metrics is not None:
+                self.metrics.observe_results(self._device, results)
+            batch_results.append(results)
+        return batch_results
+
+    async def version_info(self):
+        """Return the cached parsed reply to 'V', see DigiDog.version_info()."""
+        if self._version_info is None:
+            await self.command("V")
+        return self._version_info or {}
+
+    async def version(self):
+        """Return version number."""
+        results = await self.version_info()
+        if "device.version" in results:
+            return int(results["device.version"][-1])
+        else:
+            return 0
+
+    async def command_with_version(self, command, version=2):
+        """Execute command with if version >= $version."""
+        device_version = await self.version()
+        if device_version >= int(version):
+            return await self.command(command)
+        else:
+            raise VersionMismatch("Version requested ({}) was not met by device ({}) - Command '{}'".format(version, device_version, command))
+
+    async def blocked_commands(self):
+        """Return list of blocked commands on device as list of characters."""
+        if self._blocked is None:
+            results = await self.command_with_version("Q", 2)
+            if self._blocked is None:
+                return CapabilityCache._blocked_from_results(results)
+        return list(self._blocked)
+
+    async def arm(self):
+        """Arm timer by starting it."""
+        return await self.command("X")
+
+    async def disarm(self):
+        """Disarm timer, if it is allowed."""
+        results = await self.command("x")
+        if "command.blocked" in results and "x" in results["command.blocked"]:
+            raise CommandBlocked("Could not disarm timer because it was not allowed.")
+        if "command.executed" in results and "x" in results["command.executed"]:
+            return True
+
+    async def trigger(self):
+        """Trigger a timer reset to keep the device alive."""
+        if await self.get_timer_armed():
+            return await self.command("R")
+        else:
+            raise CommandNotSensibleInThisState("Timer is not running. It does not make any sense to trigger it.")
+
+    async def timer_up(self):
+        """Increase the timer interval."""
+        results = await self.command_with_version("+", 2)
+        if "command.blocked" in results and "+" in results["command.blocked"]:
+            raise CommandBlocked("Timer can not be adjusted.")
+        return results["timer.start"]
+
+    async def timer_down(self):
+        """Decrease the timer interval."""
+        results = await self.command_with_version("-", 2)
+        if "command.blocked" in results and "-" in results["command.blocked"]:
+            raise CommandBlocked("Timer can not be adjusted.")
+        return results["timer.start"]
+
+    async def set_timer(self, value):
+        """Set the timer to a value or just above it, see DigiDog.set_timer()."""
+        blocked = await self.blocked_commands()
+        if value <= 0 or value >=65535:
+            raise ValueError("Requested timer value of '{}' implausible. Sensible values are from 0 to 65535".format(value))
+        timer = await self.get_timer_start()
+        presses, expected = DigiDog.plan_timer(timer, value)
+        if not presses:
+            return timer
+        if presses[0] in blocked:
+            raise CommandBlocked("Timer can not be adjusted.")
+        for chunk, expected in DigiDog.timer_chunks(timer, presses):
+            timer = (await self.batch(chunk))[-1].get("timer.start")
+            if timer != expected:
+                return await self._walk_timer(await self.get_timer_start(), value)
+        return timer
+
+    async def _walk_timer(self, timer, value):
+        """Move the timer towards value one step at a time, see DigiDog._walk_timer()."""
+        over = False
+        under = False
+        timer_set = False
+        while not timer_set:
+            last = timer
+            if timer > value:
+                timer = await self.timer_down()
+                if timer < value:
+                    under = True
+                    over = False
+            elif timer < value:
+                timer = await self.timer_up()
+                if timer > value:
+                    under = False
+                    over = True
+            if last == timer or timer == value or (over and not under):
+                timer_set = True
+        return timer
+
+    async def get_timer_start(self):
+        """Request timer start value."""
+        return (await self.get_status())["timer.start"]
+
+    async def get_timer_current(self):
+        """Request current timer value."""
+        return (await self.get_status())["timer.current"]
+
+    async def get_timer_armed(self):
+        """Request whether the timer is running."""
+        return (await self.get_status())["timer.armed"]
+
+    async def get_config(self):
+        """Fetch configuration from device"""
+        return await self.command_with_version("C", 2)
+
+    async def get_status(self):
+        """Fetch operational status from device"""
+        return await self.command_with_version("S", 2)
+
+    async def eeprom_save(self):
+        """Write values to EEPROM if allowed"""
+        return await self.command_with_version(">", 2)
+
+    async def eeprom_restore(self):
+        """Read values from EEPROM and reset counters - if allowed."""
+        return await self.command_with_version("<", 2)
+
+    async def reinit_usb(self):
+        """Make the device reinitialise its USB stack and I/O ports ('!'). It
+           does not answer and may disappear from the bus for a moment."""
+        await self._communicate("!", [None])
+
+    async def lock(self):
+        """Set timer lock if supported."""
+        results = await self.command_with_version("L", 2)
+        if "command.blocked" in results and "L" in results["command.blocked"]:
+            raise CommandBlocked("Cannot lock Timer. Command blocked.")
+        if "command.executed" in results and "L" in results["command.executed"]:
+            return True
+        else:
+            return False
+
+
+class AsyncSupervisor(object):
+    """Keep several DigiDogs alive from one event loop. Every device is served
+       by its own task, so a slow or hung device does not delay the others.
+       'watchers' maps each device to an AsyncStatusWatcher fed with the
+       statuses the keepalive loop reads, see digidog.events."""
+
+    # Seconds to wait before setting up a device again after it failed.
+    RETRY_DELAY = 5
+
+    def __init__(self, devices=(), timer=1200, recovery=None):
+        """With a Recovery (see digidog.recovery), a device whose link fails is
+           recovered within the time left on its countdown."""
+        self._timer = timer
+        self.recovery = recovery
+        self._devices = []
+        self._settings = {}
+        self.watchers = {}
+        self._paused = set()
+        self._resumed = {}
+        for dev in devices:
+            self.add(dev)
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    def add(self, dev, timer=None, interval=None, scheduler=None, health=None):
+        """Add a device to serve with its own timer. It is triggered every
+           'interval' seconds if given, otherwise when its KeepaliveScheduler
+           says so. By default the supervisor's timer is used. With a
+           HealthGate (see digidog.health), triggers are withheld while it
+           does not allow them."""
+        if not isinstance(dev, AsyncDigiDog):
+            dev = AsyncDigiDog(dev)
+        self._devices.append(dev)
+        self._settings[dev] = (timer or self._timer, interval, scheduler or KeepaliveScheduler(), health)
+        self.watchers[dev] = AsyncStatusWatcher(dev, poll=False)
+        return dev
+
+    def pause(self, dev):
+        """Stop triggering a device, e.g. before it is disarmed for maintenance.
+           The timer is neither disarmed nor armed again until resume()."""
+        self._paused.add(dev)
+
+    def resume(self, dev):
+        """Trigger a paused device again."""
+        self._paused.discard(dev)
+        if dev in self._resumed:
+            self._resumed.pop(dev).set()
+
+    def paused(self, dev):
+        return dev in self._paused
+
+    async def _start(self, dev):
+        """Set the timer of a device, arm and lock it and read its configuration
+           for the observers. Return the timer value."""
+        print("{}: timer set to {}".format(dev.device, await dev.set_timer(self._settings[dev][0])))
+        timer = await dev.get_timer_start()
+        # The reply to 'X' is the status.
+        self.watchers[dev].update(await dev.arm())
+        try:
+            await dev.lock()
+        except asyncio.CancelledError:
+            # An Exception before Python 3.8
+            raise
+        except Exception as e:
+            print("{}: Could not lock timer due to exception {}".format(dev.device, e))
+        await dev.get_config()
+        return timer
+
+    async def keepalive(self, dev):
+        """Keep one device alive until the task is cancelled, then disarm it."""
+        timer = None
+        device_serial = None
+        # The configuration is read again after the link was lost, so the
+        # observers (see digidog.journal) know the recovery method in use.
+        reconnects = dev.reconnects
+        config_due = False
+        interval, scheduler, health = self._settings[dev][1:]
+        try:
+            while True:
+                if dev in self._paused:
+                    print("{}: Paused".format(dev.device))
+                    await self._resumed.setdefault(dev, asyncio.Event()).wait()
+                    print("{}: Resumed".format(dev.device))
+                try:
+                    if timer is None:
+                        timer = await self._start(dev)
+                        device_serial = (await dev.version_info()).get("device.serial", [None])[-1]
+                        reconnects = dev.reconnects
+                        config_due = False
+                    if config_due or dev.reconnects != reconnects:
+                        await dev.get_config()
+                        reconnects = dev.reconnects
+                        config_due = False
+                    started = monotonic()
+                    status = await dev.get_status()
+                    remaining = status["timer.current"]
+                    self.watchers[dev].update(status)
+                    scheduler.observe(remaining, rtt=monotonic() - started)
+                    print("{}: {:.0f}s remaining".format(dev.device, remaining / scheduler.ticks_per_second))
+                    if health is not None and not await self._healthy(dev, health, scheduler):
+                        await asyncio.sleep(interval or scheduler.delay())
+                        continue
+                    started = monotonic()
+                    results = await dev.trigger()
+                    if "R" not in results.get("command.executed", []):
+                        raise IOError("Trigger was not acknowledged")
+                    scheduler.observe(timer, rtt=monotonic() - started)
+                    await asyncio.sleep(interval or scheduler.delay())
+                except CommandNotSensibleInThisState:
+                    if dev in self._paused:
+                        continue
+                    print("{}: Could not trigger timer because it was not running. Starting timer...".format(dev.device))
+                    try:
+                        self.watchers[dev].update(await dev.arm())
+                        await dev.lock()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        print("{}: Could not restart timer due to exception: {}".format(dev.device, e))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("{}: Could not reset timer due to exception: {}".format(dev.device, e))
+                    if (self.recovery is not None and timer is not None
+                            and isinstance(e, (asyncio.TimeoutError, IOError, OSError))):
+                        exclude = [other.device for other in self._devices if other is not dev]
+                        if await self.recovery.recover(dev, device_serial, scheduler.budget(), exclude):
+                            config_due = True
+                            continue
+                    await asyncio.sleep(self.RETRY_DELAY if timer is None else interval or scheduler.min_delay)
+        except asyncio.CancelledError:
+            try:
+                await dev.disarm()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("{}: Could not disarm timer due to exception: {}".format(dev.device, e))
+            raise
+        finally:
+            dev.close()
+
+    async def _healthy(self, dev, health, scheduler):
+        """Evaluate the health checks of a device in a worker thread, within
+           the time left before the device fires. Return whether to trigger."""
+        allowed, failures = await asyncio.get_event_loop().run_in_executor(
+            None, health.evaluate, scheduler.budget())
+        for check, detail in failures:
+            print("{}: Health check {} failed: {}".format(dev.device, check.name, detail))
+        if not allowed:
+            print("{}: Withholding trigger because health checks fail".format(dev.device))
+        return allowed
+
+    async def run(self):
+        """Serve all devices until cancelled."""
+        await asyncio.gather(*[self.keepalive(dev) for dev in self._devices])
+
+
+async def probe(device, timeout=1.0):
+    """Return an open AsyncDigiDog for 'device' if a DigiDog answers 'V' on it
+       within 'timeout' seconds, None otherwise."""
+    dev = AsyncDigiDog(device)
+    try:
+        dev.open()
+        info = await asyncio.wait_for(dev.version_info(), timeout)
+    except (serial.SerialException, OSError, asyncio.TimeoutError):
+        info = {}
+    if "device.version" in info and "device.serial" in info:
+        return dev
+    dev.close()
+    return None
+
+
+async def discover(ports, timeout=1.0):
+    """Probe all ports at once and return a dict of device serial to open
+       AsyncDigiDog for every DigiDog found."""
+    found = {}
+    for dev in await asyncio.gather(*[probe(port, timeout) for port in ports]):
+        if dev is not None:
+            found[(await dev.version_info())["device.serial"][-1].upper()] = dev
+    return found
+
+
+def main(devices):
+    try:
+        asyncio.run(AsyncSupervisor(devices).run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["/dev/ttyACM0"])
@@ -0,0 +1,248 @@
+# Benchmarks of the SLCPv1 host protocol paths
+#
+# Usage: python3 -m digidog.bench [--port PORT]... [--devices N] [--duration S] [--output FILE]
+#
+# Without --port, the client talks to a loopback stand-in: the Firmware of
+# digidog.emulator answering directly from write() without serial port
+# or timer ticks, so only the cost of the client is measured. The N-device
+# keepalive benchmark then uses N pty emulators instead. With --port, real
+# devices are used; their timers are armed and disarmed again, and the
+# timer start value is restored at the end.
+#
+# Results are printed (or written to --output) as JSON.
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+from time import monotonic
+
+from .client import DigiDog
+from .emulator import EmulatorHost, Firmware
+from .protocol import LineSplitter, parse_lines
+
+
+class LoopbackSerial(object):
+    """Stand-in for serial.Serial answering from a Firmware."""
+
+    def __init__(self, firmware):
+        self._firmware = firmware
+        self._buffer = bytearray()
+        self.is_open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        for byte in bytearray(data):
+            self._buffer.extend(self._firmware.handle(byte))
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def read(self, size=1):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        end = self._buffer.find(b"\n")
+        return self.read(len(self._buffer) if end < 0 else end + 1)
+
+    def reset_input_buffer(self):
+        del self._buffer[:]
+
+
+class LoopbackDigiDog(DigiDog):
+    """DigiDog talking to a LoopbackSerial."""
+
+    def __init__(self, firmware=None, **kwargs):
+        DigiDog.__init__(self, "loopback", **kwargs)
+        self.firmware = firmware or Firmware()
+
+    def _open_port(self):
+        return LoopbackSerial(self.firmware)
+
+
+def summary(seconds):
+    """Return statistics of a list of durations in milliseconds."""
+    ms = sorted(value * 1000.0 for value in seconds)
+    return {
+        "count": len(ms),
+        "min_ms": ms[0],
+        "median_ms": statistics.median(ms),
+        "p90_ms": ms[min(len(ms) - 1, int(len(ms) * 0.9))],
+        "max_ms": ms[-1],
+        "mean_ms": statistics.mean(ms),
+    }
+
+
+def timed(function, repeat):
+    """Call function 'repeat' times and return the durations."""
+    durations = []
+    for _ in range(repeat):
+        started = monotonic()
+        function()
+        durations.append(monotonic() - started)
+    return durations
+
+
+def bench_commands(new_dog, repeat):
+    results = {}
+    with new_dog() as dev:
+        for command in ("V", "S", "C", "R"):
+            results[command] = summary(timed(lambda: dev.command(command), repeat))
+    return results
+
+
+def bench_startup(new_dog, repeat):
+    """The handshake of the keepalive loop on a device seen for the first time."""
+    def startup():
+        with new_dog() as dev:
+            dev.set_timer(1200)
+            dev.get_timer_start()
+            dev.arm()
+            try:
+                dev.lock()
+            except Exception:
+                pass
+            dev.disarm()
+
+    def probe():
+        with new_dog() as dev:
+            dev.batch(["V", "C", "S", "Q"])
+
+    return {"keepalive": summary(timed(startup, repeat)), "batch-probe": summary(timed(probe, repeat))}
+
+
+def bench_set_timer(new_dog, repeat):
+    with new_dog() as dev:
+        original = dev.get_timer_start()
+        dev.set_timer(100)
+        up = []
+        down = []
+        for _ in range(repeat):
+            up.extend(timed(lambda: dev.set_timer(65000), 1))
+            down.extend(timed(lambda: dev.set_timer(100), 1))
+        dev.set_timer(original)
+    return {"100-to-65000": summary(up), "65000-to-100": summary(down)}
+
+
+def bench_keepalive(new_dog, duration):
+    """Keepalive cycles (status check and trigger) per second on one device."""
+    with new_dog() as dev:
+        dev.arm()
+        cycles = 0
+        durations = []
+        end = monotonic() + duration
+        while monotonic() < end:
+            started = monotonic()
+            dev.trigger()
+            durations.append(monotonic() - started)
+            cycles += 1
+        dev.disarm()
+    result = summary(durations)
+    result["per_second"] = cycles / duration
+    return result
+
+
+def bench_keepalive_many(ports, duration):
+    """Keepalive cycles per second over several devices driven concurrently."""
+    from .aio import AsyncDigiDog
+
+    async def run():
+        devices = [AsyncDigiDog(port) for port in ports]
+        durations = []
+
+        async def cycle(dev):
+            async with dev:
+                await dev.arm()
+                end = monotonic() + duration
+                while monotonic() < end:
+                    started = monotonic()
+                    await dev.trigger()
+                    durations.append(monotonic() - started)
+                await dev.disarm()
+
+        await asyncio.gather(*[cycle(dev) for dev in devices])
+        return durations
+
+    durations = asyncio.run(run())
+    result = summary(durations)
+    result["devices"] = len(ports)
+    result["per_second"] = len(durations) / duration
+    return result
+
+
+def recorded_stream():
+    """Replies of a startup and a run of keepalive cycles, as the firmware sends them."""
+    firmware = Firmware()
+    stream = bytearray()
+    for command in b"VCSQX" + b"SR" * 50 + b"+-" * 10 + b"x":
+        stream.extend(firmware.handle(command))
+        firmware.tick()
+    return bytes(stream)
+
+
+def bench_parser(repeat):
+    stream = recorded_stream()
+    lines = stream.splitlines()
+    results = {"stream_bytes": len(stream)}
+    for name, function in (("parse_lines", lambda: parse_lines(lines)),
+                           ("LineSplitter", lambda: parse_lines(LineSplitter().feed(stream)))):
+        best = min(timed(function, repeat))
+        results[name] = {"lines_per_second": len(lines) / best, "megabytes_per_second": len(stream) / best / 1e6}
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the DigiDog host protocol paths.")
+    parser.add_argument("--port", action="append", default=[], help="device to use instead of the loopback")
+    parser.add_argument("--devices", type=int, default=8, help="emulators for the multi-device benchmark")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per keepalive benchmark")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv[1:])
+
+    if args.port:
+        new_dog = lambda: DigiDog(args.port[0])
+    else:
+        new_dog = LoopbackDigiDog
+    report = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "target": args.port or "loopback",
+        "commands": bench_commands(new_dog, args.repeat),
+        "startup": bench_startup(new_dog, max(1, args.repeat // 10)),
+        "set_timer": bench_set_timer(new_dog, max(1, args.repeat // 10)),
+        "keepalive": bench_keepalive(new_dog, args.duration),
+        "parser": bench_parser(args.repeat),
+    }
+    if args.port:
+        report["keepalive_many"] = bench_keepalive_many(args.port, args.duration)
+    else:
+        with EmulatorHost() as host:
+            ports = [host.add(serial=0x10000000 + index).port for index in range(args.devices)]
+            report["keepalive_many"] = bench_keepalive_many(ports, args.duration)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
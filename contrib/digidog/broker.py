@@ -0,0 +1,337 @@
+# Local control socket of the keepalive daemon
+#
+# The daemon owns the ports of its DigiDogs. With 'socket' set, other
+# processes send their requests to it over a Unix domain socket instead of
+# opening the port themselves. Each request is one line with a JSON
+# object, each reply as well:
+#
+#   {"command": "status", "device": "10000002"}
+#   {"ok": true, "device": "10000002", "results": {...}, "age": 0.4}
+#   {"ok": false, "error": "..."}
+#
+# "device" is the serial reported in O: and may be left out if the daemon
+# serves a single device. Commands are status (S), config (C), trigger,
+# arm and disarm. Disarming pauses the keepalive of the device until it is
+# armed again through the socket.
+#
+# "subscribe" turns the connection into a stream of the change events of
+# the device (see digidog.events) seen by the keepalive loop, one line
+# each after the reply, until the client closes it:
+#
+#   {"command": "subscribe", "device": "10000002"}
+#   {"ok": true, "device": "10000002"}
+#   {"event": "fired", "device": "10000002", "at": ..., "old": false, "new": true}
+#
+# A client that does not keep up loses the oldest of more than MAX_EVENTS
+# pending events.
+#
+# status and config are answered from the last reply of the device if it
+# is at most 'max_age' seconds old ("age" in the reply); concurrent
+# identical queries share one exchange with the device. A Broker is an
+# observer of the devices as well (see digidog.metrics.Observers), so the
+# replies to the keepalive loop's own queries are served too.
+#
+# A stale socket file at the path is replaced; anything else there, or a
+# socket another process still listens on, is left alone and an error
+# raised.
+
+import asyncio
+import collections
+import errno
+import json
+import os
+import socket
+import stat
+from time import monotonic
+
+from .client import DigiDog
+from .protocol import CommandBlocked, CommandNotSensibleInThisState, VersionMismatch, parse_lines
+
+
+class Broker(object):
+    """Serve requests for several AsyncDigiDogs on a Unix domain socket."""
+
+    # Request name -> command whose reply is cached
+    QUERIES = {"status": "S", "config": "C"}
+    # Longest request line accepted
+    MAX_REQUEST = 4096
+    # Events kept for a subscriber
+    MAX_EVENTS = 256
+
+    def __init__(self, devices, supervisor=None, max_age=1.0):
+        """'devices' maps device serials to AsyncDigiDogs. If the devices are
+           kept alive by an AsyncSupervisor, pass it so disarm and arm pause and
+           resume their keepalive."""
+        self.devices = dict((device_serial.upper(), dev) for device_serial, dev in devices.items())
+        self.supervisor = supervisor
+        self.max_age = max_age
+        self._snapshots = {}
+        self._pending = {}
+
+    async def query(self, device_serial, command):
+        """Return the time and results of the last reply to 'command' if it is
+           recent enough, otherwise ask the device. Callers asking while an
+           exchange is under way share its result."""
+        key = (device_serial, command)
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None and monotonic() - snapshot[0] <= self.max_age:
+            return snapshot
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._read(key))
+            pending.add_done_callback(lambda future: self._pending.pop(key, None))
+        # A client going away must not cancel the exchange of the others.
+        return await asyncio.shield(pending)
+
+    async def _read(self, key):
+        device_serial, command = key
+        started = monotonic()
+        results = await self.devices[device_serial].command_with_version(command, 2)
+        self._snapshots[key] = (started, results)
+        return self._snapshots[key]
+
+    def _forget(self, device_serial, command="S"):
+        self._snapshots.pop((device_serial, command), None)
+
+    def _serial_of(self, device):
+        for device_serial, dev in self.devices.items():
+            if dev.device == device:
+                return device_serial
+        return None
+
+    def observe_exchange(self, device, commands, replies, seconds):
+        """Keep complete replies to queries made by others, e.g. the
+           keepalive loop, as snapshots."""
+        device_serial = self._serial_of(device)
+        if device_serial is None:
+            return
+        started = monotonic() - seconds
+        for command, lines in zip(commands, replies):
+            if command == "R":
+                # The countdown started again.
+                self._forget(device_serial)
+            elif command in Broker.QUERIES.values() and lines and lines[-1].startswith(DigiDog.REPLY_END[command]):
+                self._snapshots[(device_serial, command)] = (started, parse_lines(lines))
+
+    def observe_timeout(self, device, commands):
+        pass
+
+    def observe_reconnect(self, device):
+        pass
+
+    def observe_move(self, device, new_device):
+        pass
+
+    def observe_lines(self, device, dropped, malformed):
+        pass
+
+    def observe_results(self, device, results):
+        pass
+
+    def _device_serial(self, request):
+        """Return the serial of the device a request is for, None if unknown."""
+        device_serial = request.get("device")
+        if device_serial is None and len(self.devices) == 1:
+            device_serial = next(iter(self.devices))
+        device_serial = str(device_serial).upper()
+        return device_serial if device_serial in self.devices else None
+
+    async def handle(self, request):
+        """Answer one request (a dict) and return the reply (a dict)."""
+        name = request.get("command")
+        device_serial = self._device_serial(request)
+        if device_serial is None:
+            return {"ok": False, "error": "Unknown device {}".format(request.get("device"))}
+        dev = self.devices[device_serial]
+        reply = {"ok": True, "device": device_serial}
+        try:
+            if name in Broker.QUERIES:
+                at, results = await self.query(device_serial, Broker.QUERIES[name])
+                reply["results"] = results
+                reply["age"] = monotonic() - at
+            elif name == "trigger":
+                reply["results"] = await dev.trigger()
+                self._forget(device_serial)
+            elif name == "arm":
+                # The reply to 'X' is the status.
+                started = monotonic()
+                reply["results"] = await dev.arm()
+                self._snapshots[(device_serial, "S")] = (started, reply["results"])
+                if self.supervisor is not None:
+                    self.supervisor.resume(dev)
+            elif name == "disarm":
+                if self.supervisor is not None:
+                    self.supervisor.pause(dev)
+                try:
+                    reply["results"] = {"command.executed": ["x"]} if await dev.disarm() else {}
+                except Exception:
+                    if self.supervisor is not None:
+                        self.supervisor.resume(dev)
+                    raise
+                finally:
+                    self._forget(device_serial)
+            else:
+                return {"ok": False, "error": "Unknown command {}".format(name)}
+        except (CommandBlocked, CommandNotSensibleInThisState, VersionMismatch) as e:
+            return {"ok": False, "device": device_serial, "error": str(e)}
+        except (asyncio.TimeoutError, IOError, OSError) as e:
+            return {"ok": False, "device": device_serial, "error": "Could not talk to the DigiDog: {}".format(e)}
+        return reply
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than MAX_REQUEST; the stream is out of step.
+                    writer.write(json.dumps({"ok": False, "error": "Request too long"}).encode("utf-8") + b"\n")
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise ValueError("not an object")
+                except ValueError as e:
+                    reply = {"ok": False, "error": "Invalid request: {}".format(e)}
+                else:
+                    if request.get("command") == "subscribe":
+                        await self._subscribe(request, reader, writer)
+                        break
+                    reply = await self.handle(request)
+                writer.write(json.dumps(reply, sort_keys=True).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _subscribe(self, request, reader, writer):
+        """Answer a subscribe request, then write the events of the device
+           until the client closes the connection."""
+        device_serial = self._device_serial(request)
+        if device_serial is None:
+            reply = {"ok": False, "error": "Unknown device {}".format(request.get("device"))}
+        elif self.supervisor is None or self.devices[device_serial] not in self.supervisor.watchers:
+            reply = {"ok": False, "device": device_serial, "error": "Events need the keepalive loop"}
+        else:
+            reply = {"ok": True, "device": device_serial}
+        writer.write(json.dumps(reply, sort_keys=True).encode("utf-8") + b"\n")
+        if not reply["ok"]:
+            return
+        watcher = self.supervisor.watchers[self.devices[device_serial]]
+        events = collections.deque(maxlen=Broker.MAX_EVENTS)
+        ready = asyncio.Event()
+
+        def deliver(event):
+            events.append(event)
+            ready.set()
+
+        watcher.subscribe(deliver)
+        closed = asyncio.ensure_future(Broker._until_closed(reader))
+        try:
+            while not closed.done():
+                while events:
+                    event = events.popleft()
+                    writer.write(json.dumps({"event": event.kind, "device": device_serial, "at": event.at,
+                                             "old": event.old, "new": event.new}, sort_keys=True).encode("utf-8") + b"\n")
+                await writer.drain()
+                ready.clear()
+                waiter = asyncio.ensure_future(ready.wait())
+                try:
+                    await asyncio.wait([waiter, closed], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+        finally:
+            watcher.unsubscribe(deliver)
+            closed.cancel()
+
+    @staticmethod
+    async def _until_closed(reader):
+        """Skip whatever a subscriber sends until it closes the connection."""
+        while await reader.read(Broker.MAX_REQUEST):
+            pass
+
+    @staticmethod
+    def _remove_stale(path):
+        """Remove the socket file at 'path' if nobody listens on it any more."""
+        try:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise OSError(errno.EEXIST, "Not a socket, leaving it alone", path)
+        except FileNotFoundError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+        except FileNotFoundError:
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, "Another process listens on the socket", path)
+
+    async def serve(self, path, mode=0o660):
+        """Listen on 'path' until cancelled. The socket is created with
+           'mode' already, so it is never accessible to others."""
+        Broker._remove_stale(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o777 & ~mode)
+        try:
+            listener.bind(path)
+        except OSError:
+            listener.close()
+            raise
+        finally:
+            os.umask(umask)
+        inode = os.stat(path).st_ino
+        server = await asyncio.start_unix_server(self._client, sock=listener, limit=Broker.MAX_REQUEST)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            try:
+                # Unless somebody replaced it meanwhile
+                if os.stat(path).st_ino == inode:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def request(path, message, timeout=5.0):
+    """Send one request (a dict) to the broker at 'path' and return its reply."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        client.close()
+    return json.loads(data.decode("utf-8"))
+
+
+def subscribe(path, device=None):
+    """Yield the events (dicts) of a device from the broker at 'path' until
+       the connection ends, see "subscribe" above."""
+    message = {"command": "subscribe"}
+    if device is not None:
+        message["device"] = device
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        stream = client.makefile("rb")
+        reply = json.loads(stream.readline().decode("utf-8") or "{}")
+        if not reply.get("ok"):
+            raise IOError(reply.get("error", "Connection closed"))
+        for line in stream:
+            yield json.loads(line.decode("utf-8"))
+    finally:
+        client.close()
@@ -0,0 +1,113 @@
+# Calibration of the timer tick of DigiDogs
+#
+# Usage: digidog calibrate [--window SECONDS]
+#
+# The firmware decrements its timer once per loop(), which waits 100 ms
+# and then does its work, so a tick takes a little longer than 100 ms and
+# each device has its own rate (DigiDog_config.h: 1200 is "about 123s").
+# calibrate() reads C: of a running timer for 'window' seconds and fits
+# the ticks per second against the monotonic clock of the host.
+#
+# The rates are kept by device serial in a JSON file, CALIBRATION_FILE by
+# default:
+#
+#   {"10000002": {"ticks_per_second": 9.7561, "samples": 61, "at": ...}}
+#
+# DigiDog.ticks_per_second and KeepaliveScheduler take the rate of a
+# device; the daemon reads them from the file given as 'calibration'.
+
+import json
+import os
+import time
+from time import monotonic
+
+from .protocol import CommandNotSensibleInThisState
+
+CALIBRATION_FILE = "/var/lib/digidog/calibration.json"
+
+
+def fit(samples):
+    """Return the ticks per second of (monotonic time, countdown) samples by
+       least squares, None if they do not span any time."""
+    if len(samples) < 2:
+        return None
+    mean_t = sum(at for at, ticks in samples) / len(samples)
+    mean_ticks = sum(ticks for at, ticks in samples) / len(samples)
+    spread = sum((at - mean_t) ** 2 for at, ticks in samples)
+    if not spread:
+        return None
+    slope = sum((at - mean_t) * (ticks - mean_ticks) for at, ticks in samples) / spread
+    return -slope
+
+
+def calibrate(dev, window=60.0, interval=1.0):
+    """Sample the countdown of a DigiDog for 'window' seconds and return
+       (ticks per second, samples). A running timer is triggered first; a
+       stopped one is armed and disarmed again afterwards. If the countdown
+       is restarted by somebody else, the samples before are dropped."""
+    status = dev.get_status()
+    armed = status["timer.armed"]
+    if status["timer.start"] / dev.ticks_per_second < window * 1.5:
+        raise ValueError("Timer of {} ticks is too short for a calibration window of {}s".format(
+            status["timer.start"], window))
+    if armed:
+        dev.trigger()
+    else:
+        dev.arm()
+    samples = []
+    try:
+        end = monotonic() + window
+        while True:
+            started = monotonic()
+            status = dev.get_status()
+            if not status.get("timer.armed"):
+                raise CommandNotSensibleInThisState("Timer stopped during the calibration.")
+            # The countdown is taken to be read halfway through the exchange.
+            at = (started + monotonic()) / 2
+            if samples and status["timer.current"] > samples[-1][1]:
+                samples = []
+            samples.append((at, status["timer.current"]))
+            if at >= end:
+                break
+            time.sleep(max(min(interval, end - monotonic()), 0.0))
+    finally:
+        if not armed:
+            dev.disarm()
+    rate = fit(samples)
+    if rate is None or rate <= 0:
+        raise ValueError("Countdown did not run during the calibration.")
+    return rate, len(samples)
+
+
+class CalibrationCache(object):
+    """Ticks per second of devices by serial, kept in a JSON file."""
+
+    def __init__(self, path=CALIBRATION_FILE):
+        self.path = path
+        self.devices = {}
+        try:
+            with open(path) as cache_file:
+                self.devices = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def get(self, device_serial, default=None):
+        """Return the ticks per second of a device, 'default' if not calibrated."""
+        entry = self.devices.get(device_serial.upper())
+        if not isinstance(entry, dict) or not entry.get("ticks_per_second"):
+            return default
+        return float(entry["ticks_per_second"])
+
+    def set(self, device_serial, ticks_per_second, samples=None):
+        self.devices[device_serial.upper()] = {"ticks_per_second": round(ticks_per_second, 6),
+                                               "samples": samples, "at": round(time.time(), 3)}
+
+    def save(self):
+        """Write the file at once, so readers never see half of it."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temporary, "w") as cache_file:
+            json.dump(self.devices, cache_file, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
@@ -0,0 +1,253 @@
+# Record and replay the serial traffic of a DigiDog
+#
+# Usage: python3 -m digidog.capture show LOG
+#        python3 -m digidog.capture replay LOG [speed]
+#
+# A Recorder is passed as 'transport' to DigiDog and tees all bytes written
+# to and read from the port into a CaptureLog, which keeps only the most
+# recent records within a fixed number of bytes:
+#
+#   log = CaptureLog()
+#   dev = DigiDog(WDT_DEVICE, transport=Recorder(log))
+#   ...
+#   log.save("/var/tmp/digidog.log")
+#
+# AsyncDigiDog takes a Recorder as well; it needs ports that do not block:
+#
+#   dev = AsyncDigiDog(WDT_DEVICE, transport=Recorder(log, AsyncSerialPort.open_serial))
+#
+# The daemon records every device this way with 'capture' set (see
+# digidog.daemon).
+#
+# A Replayer passed as 'transport' to DigiDog answers its commands with
+# the recorded replies, at the recorded pace divided by 'speed' (0 answers
+# at once).
+#
+# The log starts with MAGIC, followed by records of a header (monotonic
+# timestamp as double, direction, length) and the bytes.
+
+import collections
+import os
+import struct
+import sys
+import time
+from time import monotonic
+
+from .client import DigiDog
+
+MAGIC = b"DDCAP1\n"
+HEADER = struct.Struct("<dcH")
+WRITE = b"w"
+READ = b"r"
+
+
+class CaptureLog(object):
+    """Ring buffer of timestamped chunks written to or read from a port."""
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.size = 0
+        self.dropped = 0
+        self._records = collections.deque()
+
+    def append(self, direction, data, at=None):
+        """Add a chunk, dropping the oldest records if the log gets too large."""
+        at = monotonic() if at is None else at
+        for start in range(0, len(data), 0xFFFF):
+            chunk = bytes(data[start:start + 0xFFFF])
+            record = HEADER.pack(at, direction, len(chunk)) + chunk
+            self._records.append(record)
+            self.size += len(record)
+        while self.size > self.capacity and self._records:
+            self.size -= len(self._records.popleft())
+            self.dropped += 1
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        """Yield the records as tuples of timestamp, direction and bytes."""
+        for record in list(self._records):
+            at, direction, length = HEADER.unpack_from(record)
+            yield at, direction, record[HEADER.size:]
+
+    def save(self, path):
+        """Write the log to 'path', replacing it at once so a log saved
+           while recording is never seen half written."""
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "wb") as log_file:
+            log_file.write(MAGIC)
+            for record in list(self._records):
+                log_file.write(record)
+        os.replace(temp, path)
+
+    @staticmethod
+    def load(path, capacity=None):
+        """Read a log written by save()."""
+        with open(path, "rb") as log_file:
+            data = log_file.read()
+        if not data.startswith(MAGIC):
+            raise ValueError("{} is not a DigiDog capture log".format(path))
+        log = CaptureLog(capacity or len(data))
+        offset = len(MAGIC)
+        while offset + HEADER.size <= len(data):
+            at, direction, length = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            log.append(direction, data[offset:offset + length], at)
+            offset += length
+        return log
+
+
+class RecordingPort(object):
+    """Serial port wrapper copying all traffic into a CaptureLog."""
+
+    def __init__(self, port, log):
+        self._port = port
+        self._log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def write(self, data):
+        self._log.append(WRITE, data)
+        return self._port.write(data)
+
+    def read(self, size=1):
+        return self._received(self._port.read(size))
+
+    def readline(self):
+        return self._received(self._port.readline())
+
+    def _received(self, data):
+        if data:
+            self._log.append(READ, data)
+        return data
+
+    def close(self):
+        self._port.close()
+
+
+class Recorder(object):
+    """DigiDog transport recording the traffic of the ports it opens.
+       'transport' opens them, DigiDog.open_serial by default."""
+
+    def __init__(self, log, transport=None):
+        self.log = log
+        self._transport = transport or DigiDog.open_serial
+
+    def __call__(self, device):
+        return RecordingPort(self._transport(device), self.log)
+
+
+class ReplayPort(object):
+    """Serial port stand-in answering each write with the chunks that were
+       read after the matching write of a CaptureLog."""
+
+    def __init__(self, records, speed=1.0):
+        self._records = records
+        self._speed = speed
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self.is_open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        del self._buffer[:]
+        self._pending.clear()
+
+    def write(self, data):
+        """Skip to the next recorded write and queue the chunks read after it."""
+        while self._records and self._records[0][1] != WRITE:
+            self._records.popleft()
+        if not self._records:
+            raise EOFError("Capture log exhausted")
+        written_at, direction, written = self._records.popleft()
+        now = monotonic()
+        while self._records and self._records[0][1] == READ:
+            at, direction, chunk = self._records.popleft()
+            delay = (at - written_at) / self._speed if self._speed else 0.0
+            self._pending.append((now + delay, chunk))
+        return len(data)
+
+    def _fill(self):
+        """Move the next due chunk into the buffer, waiting for it if needed.
+           Return False once all chunks of the current write are used."""
+        if not self._pending:
+            return False
+        due, chunk = self._pending.popleft()
+        wait = due - monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._buffer.extend(chunk)
+        return True
+
+    @property
+    def in_waiting(self):
+        while self._pending and self._pending[0][0] <= monotonic():
+            self._buffer.extend(self._pending.popleft()[1])
+        return len(self._buffer)
+
+    def read(self, size=1):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        while b"\n" not in self._buffer and self._fill():
+            pass
+        end = self._buffer.find(b"\n")
+        return self.read(len(self._buffer) if end < 0 else end + 1)
+
+
+class Replayer(object):
+    """DigiDog transport replaying a CaptureLog. All ports opened share the
+       position in the log."""
+
+    def __init__(self, log, speed=1.0):
+        self._records = collections.deque(log)
+        self.speed = speed
+
+    def __call__(self, device):
+        return ReplayPort(self._records, self.speed)
+
+    def writes(self):
+        """Return the commands that are left to replay."""
+        return [data.decode("ascii", "replace") for at, direction, data in self._records if direction == WRITE]
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ("show", "replay"):
+        print("Usage: python3 -m digidog.capture show|replay LOG [speed]")
+        return 2
+    log = CaptureLog.load(argv[2])
+    if argv[1] == "show":
+        start = None
+        for at, direction, data in log:
+            start = at if start is None else start
+            print("{:12.6f} {} {!r}".format(at - start, direction.decode("ascii"), data))
+        return 0
+    replayer = Replayer(log, float(argv[3]) if len(argv) > 3 else 1.0)
+    with DigiDog("replay", transport=replayer) as dev:
+        for command in replayer.writes():
+            print("{!r}: {}".format(command, dev.command(command)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,190 @@
+# Command line interface: digidog [-d DEVICE] COMMAND
+#
+#   status      print the timer status (S)
+#   config      print the configuration (C)
+#   arm         start the timer
+#   disarm      stop the timer, if allowed
+#   trigger     restart the countdown of a running timer
+#   set-timer   set the timer start value in ticks of about 100 ms, or
+#               in seconds with --seconds using the calibrated rate
+#   apply       set timer start and recovery method and save them, if
+#               they differ (see DigiDog.apply_config())
+#   calibrate   measure the timer rate and store it, see digidog.calibration
+#   daemon      keep all DigiDogs of this host alive, see digidog.daemon
+#   report      list the fire events in journals of the daemon
+#
+# One-shot commands open the port once and send only what they need; the
+# version check is sent in the same write as the query. The asyncio
+# client and daemon are only imported for "daemon".
+#
+# With --socket, status, config, arm, disarm and trigger are sent to a
+# running daemon instead (see digidog.broker), which may answer queries
+# from its cache without touching the device.
+
+import argparse
+import sys
+
+from . import WDT_DEVICE, calibration
+from .client import DigiDog
+from .protocol import CommandBlocked, CommandNotSensibleInThisState, VersionMismatch
+
+
+def query(dev, command):
+    """Return the results of a command that needs version 2, reading the
+       version in the same write."""
+    version_results, results = dev.batch(["V", command])
+    if dev.version() < 2:
+        raise VersionMismatch("Version requested (2) was not met by device ({}) - Command '{}'".format(dev.version(), command))
+    return results
+
+
+def show(results, as_json):
+    if as_json:
+        import json
+        print(json.dumps(results, sort_keys=True))
+        return
+    for name, value in sorted(results.items()):
+        print("{}: {}".format(name, value))
+
+
+def status(dev, args):
+    show(query(dev, "S"), args.json)
+
+
+def config(dev, args):
+    show(query(dev, "C"), args.json)
+
+
+def arm(dev, args):
+    show(dev.arm(), args.json)
+
+
+def disarm(dev, args):
+    dev.disarm()
+
+
+def trigger(dev, args):
+    if not query(dev, "S").get("timer.armed"):
+        raise CommandNotSensibleInThisState("Timer is not running. It does not make any sense to trigger it.")
+    dev.command("R")
+
+
+def set_timer(dev, args):
+    if not args.seconds:
+        print(dev.set_timer(int(args.value)))
+        return
+    device_serial = dev.version_info().get("device.serial", [""])[-1]
+    dev.ticks_per_second = calibration.CalibrationCache(args.calibration).get(device_serial, DigiDog.TICKS_PER_SECOND)
+    print("{:.1f}".format(dev.set_timer_seconds(args.value)))
+
+
+def calibrate(dev, args):
+    device_serial = dev.version_info().get("device.serial", [""])[-1]
+    rate, samples = calibration.calibrate(dev, args.window, args.interval)
+    cache = calibration.CalibrationCache(args.calibration)
+    cache.set(device_serial, rate, samples)
+    cache.save()
+    print("{}: {:.4f} ticks per second from {} samples".format(device_serial, rate, samples))
+
+
+def apply(dev, args):
+    desired = {}
+    if args.timer is not None:
+        desired["timer.start"] = args.timer
+    if args.recovery is not None:
+        desired["target.recovery-method"] = args.recovery
+    if not desired:
+        raise ValueError("Nothing to apply. Give --timer and/or --recovery")
+    show(dev.apply_config(desired, persist=args.save), args.json)
+
+
+def via_socket(args):
+    """Send the command to the daemon listening on args.socket."""
+    from .broker import request
+    message = {"command": args.command}
+    if args.serial:
+        message["device"] = args.serial
+    reply = request(args.socket, message)
+    if not reply.get("ok"):
+        print("{}: {}".format(reply.get("device", args.socket), reply.get("error")), file=sys.stderr)
+        return 1
+    if args.function in (status, config, arm):
+        show(reply["results"], args.json)
+    return 0
+
+
+def daemon(args):
+    from .daemon import main as daemon_main
+    return daemon_main(["digidog daemon"] + ([args.config] if args.config else []))
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog="digidog", description="Control DigiDog USB watchdogs.")
+    parser.add_argument("-d", "--device", default=WDT_DEVICE, help="serial port of the DigiDog (default: %(default)s)")
+    parser.add_argument("--socket", help="ask the daemon listening here instead of opening the port")
+    parser.add_argument("--serial", help="serial of the DigiDog to ask the daemon about")
+    parser.add_argument("--calibration", default=calibration.CALIBRATION_FILE,
+                        help="file with the calibrated timer rates (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+    for name, function, text in (("status", status, "print the timer status"),
+                                 ("config", config, "print the configuration")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("--json", action="store_true", help="print the results as JSON")
+        command.set_defaults(function=function)
+    for name, function, text in (("arm", arm, "start the timer"),
+                                 ("disarm", disarm, "stop the timer, if allowed"),
+                                 ("trigger", trigger, "restart the countdown of a running timer")):
+        command = commands.add_parser(name, help=text)
+        command.set_defaults(function=function, json=False)
+    command = commands.add_parser("set-timer", help="set the timer start value")
+    command.add_argument("value", type=float, help="ticks of about 100 ms, or seconds with --seconds")
+    command.add_argument("--seconds", action="store_true", help="the value is in seconds")
+    command.set_defaults(function=set_timer)
+    command = commands.add_parser("calibrate", help="measure the timer rate of the device and store it")
+    command.add_argument("--window", type=float, default=60.0, help="seconds to measure (default: %(default)s)")
+    command.add_argument("--interval", type=float, default=1.0, help="seconds between samples (default: %(default)s)")
+    command.set_defaults(function=calibrate)
+    command = commands.add_parser("apply", help="set and save the configuration where it differs")
+    command.add_argument("--timer", type=int, help="timer start value in ticks of about 100 ms")
+    command.add_argument("--recovery", choices=sorted(DigiDog.RECOVERY_METHODS), help="recovery method")
+    command.add_argument("--no-save", dest="save", action="store_false", help="do not write the EEPROM")
+    command.add_argument("--json", action="store_true", help="print the configuration as JSON")
+    command.set_defaults(function=apply)
+    command = commands.add_parser("daemon", help="keep all DigiDogs of this host alive")
+    command.add_argument("config", nargs="?", help="configuration file, see digidog.daemon")
+    command.set_defaults(function=None)
+    command = commands.add_parser("report", help="list the fire events in journals of the daemon")
+    command.add_argument("journals", nargs="+", metavar="JOURNAL", help="journal files, e.g. one per host")
+    command.add_argument("--json", action="store_true", help="print one JSON object per event")
+    command.set_defaults(function=None)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.command == "report":
+        from .journal import print_report
+        print_report(args.journals, args.json)
+        return 0
+    if args.function is None:
+        return daemon(args)
+    if args.socket:
+        if args.function in (set_timer, apply, calibrate):
+            print("{} is not available through the daemon".format(args.command), file=sys.stderr)
+            return 1
+        try:
+            return via_socket(args)
+        except (IOError, OSError, ValueError) as e:
+            print("{}: Could not talk to the daemon: {}".format(args.socket, e), file=sys.stderr)
+            return 2
+    try:
+        with DigiDog(args.device) as dev:
+            args.function(dev, args)
+    except (CommandBlocked, CommandNotSensibleInThisState, VersionMismatch, ValueError) as e:
+        print("{}: {}".format(args.device, e), file=sys.stderr)
+        return 1
+    except (IOError, OSError) as e:
+        print("{}: Could not talk to the DigiDog: {}".format(args.device, e), file=sys.stderr)
+        return 2
+    return 0
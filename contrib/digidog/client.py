@@ -0,0 +1,655 @@
+# Synchronous client for DigiDog devices
+#
+# pyserial is imported when the first port is opened, so importing this
+# module (and parsing replies) works without it and costs little.
+
+import collections
+import math
+from time import monotonic
+
+from .protocol import (FIELDS, CommandBlocked, CommandNotSensibleInThisState, ConfigMismatch,
+                       LineSplitter, VersionMismatch, _text, parse_lines)
+
+
+def _serial():
+    """Return the pyserial module, importing it on first use."""
+    import serial
+    return serial
+
+
+def _port_errors():
+    """Return the exceptions a port raises when its device went away. Besides
+       SerialException, pyserial lets OSError of its ioctls (in_waiting) and
+       termios.error (reset_input_buffer) through."""
+    errors = (_serial().SerialException, OSError)
+    try:
+        import termios
+    except ImportError:
+        return errors
+    return errors + (termios.error,)
+
+
+class CapabilityCache(object):
+    """Cache of the version information and blocked commands of a device.
+       Both only change when the device reboots, is replaced or its timer
+       gets locked, so they are kept until a reply suggests so."""
+
+    _version_info = None
+    _blocked = None
+
+    def _update_capabilities(self, command, results):
+        """Drop cached capabilities if a command or its results show that they
+           may have changed. Complete replies to 'V' and 'Q' are cached."""
+        if "#" in command or "<" in command:
+            # The device may reboot or have its EEPROM (and serial) reset.
+            self.invalidate_capabilities()
+        elif "L" in command:
+            # A locked timer may no longer be stopped.
+            self._blocked = None
+        if self._version_info is not None and "device.serial" in results:
+            if results["device.serial"] != self._version_info.get("device.serial"):
+                self.invalidate_capabilities()
+        if command == "V" and "device.version" in results:
+            self._version_info = results
+        elif command == "Q" and "Q" in results.get("command.blocked", []):
+            self._blocked = CapabilityCache._blocked_from_results(results)
+
+    def invalidate_capabilities(self):
+        """Forget cached version information and blocked commands."""
+        self._version_info = None
+        self._blocked = None
+
+    @staticmethod
+    def _blocked_from_results(results):
+        """Return the blocked commands from the results of 'Q'."""
+        if "command.blocked" not in results:
+            return []
+        blocked_commands = list(results["command.blocked"])
+        try:
+            blocked_commands.remove("Q")
+        except ValueError:
+            raise ValueError("List of blocked commands is not complete.")
+        return blocked_commands
+
+
+class LineCounter(object):
+    """Totals of the lines of a device that LineSplitter dropped as overlong
+       or passed on as malformed, reported to 'metrics' as well."""
+
+    dropped_lines = 0
+    malformed_lines = 0
+
+    def _count_lines(self, dropped, malformed):
+        """Add the overlong lines dropped and the malformed lines passed on
+           in an exchange to the totals and report them to 'metrics'."""
+        if dropped or malformed:
+            self.dropped_lines += dropped
+            self.malformed_lines += malformed
+            if self.metrics is not None:
+                self.metrics.observe_lines(self._device, dropped, malformed)
+
+
+class DigiDog(CapabilityCache, LineCounter):
+    """Abstraction of DigiDog device."""
+
+    # Key of a reply line -> name in the results of command()
+    ARGMAP=dict((_text(key), field[0]) for key, field in FIELDS.items())
+
+    # Timer limits and step of '+' and '-' as set in DigiDog_config.h
+    TIMER_SET_STEP=100
+    TIMER_SET_MIN=100
+    TIMER_SET_MAX=65000
+    # The firmware decrements the timer once per loop(), about every 100 ms.
+    # See digidog.calibration for the rate of a particular device.
+    TICKS_PER_SECOND=10.0
+    # Recovery method ("target.recovery-method") -> command selecting it
+    RECOVERY_METHODS={"reset": "m", "power": "M"}
+    # Presses of '+' or '-' sent in one write. The input buffer of DigiCDC
+    # is small and loop() empties it once per pass, so a long burst only
+    # trickles in and its replies could outlast the read timeouts. Chunks
+    # of this size are taken within a pass or two, and the timer value
+    # each chunk ends with is checked before the next is sent.
+    TIMER_CHUNK=32
+
+    # Bytes read per command at most. A device that keeps sending (line
+    # noise answered with X:, a loop of output) can not hold up a read
+    # longer than this takes.
+    MAX_REPLY=512
+    READ_CHUNK=64
+
+    # Beginnings of the line that ends the reply to a command. Commands
+    # that may be blocked also end with the matching "Q:" line. Replies
+    # to commands not listed here are read until the port times out.
+    REPLY_END={
+        "V": (b"O:",),
+        "S": (b"#:",),
+        "C": (b"R:",),
+        "Q": (b"Q:Q",),
+        "R": (b"P:R",),
+        "X": (b"#:",),
+        "x": (b"#:",),
+        "*": (b"#:",),
+        "<": (b"#:",),
+        ">": (b"P:>", b"Q:>"),
+        "+": (b"S:", b"Q:+"),
+        "-": (b"S:", b"Q:-"),
+        "m": (b"N:", b"Q:m"),
+        "M": (b"N:", b"Q:M"),
+        "0": (b"L:", b"Q:0"),
+        "L": (b"P:L", b"Q:L", b"X:"),
+    }
+
+    def __init__(self, device, metrics=None, transport=None, ticks_per_second=None):
+        """Contructor for Watchdog abstraction. 'metrics' is informed about
+           every exchange, see digidog.metrics.Metrics. 'transport' is called
+           with the device to open its port instead of open_serial(), e.g. to
+           record or replay the traffic (see digidog.capture).
+           'ticks_per_second' is the calibrated rate of the timer, used to
+           convert seconds to ticks and back."""
+        self._device = device
+        self.metrics = metrics
+        self.ticks_per_second = ticks_per_second or DigiDog.TICKS_PER_SECOND
+        self._transport = transport or DigiDog.open_serial
+        self._sdev = None
+        self._session = False
+        self._version_info = None
+        self._blocked = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def open_serial(device):
+        """Open the serial port of a device and return it."""
+        return _serial().Serial(device, 9600, xonxoff=False, rtscts=False, timeout=.2)
+
+    def _open_port(self):
+        """Open the port of the device through its transport and return it."""
+        return self._transport(self._device)
+
+    def open(self):
+        """Start a session. The port is kept open until close() is called."""
+        self._session = True
+        if self._sdev is None:
+            self._sdev = self._open_port()
+            # This may be another device or the same one after a reboot.
+            self.invalidate_capabilities()
+
+    def _drop_port(self):
+        """Close the session port without ending the session."""
+        if self._sdev is not None:
+            try:
+                self._sdev.close()
+            except _port_errors():
+                pass
+            finally:
+                self._sdev = None
+
+    def close(self):
+        """End a session and close the port if it is open."""
+        self._session = False
+        self._drop_port()
+
+    def reopen(self):
+        """Close and open the session port again, e.g. after the device was replugged."""
+        self._drop_port()
+        self.open()
+
+    @property
+    def in_session(self):
+        """True if a session is active. The port may be closed temporarily
+           while the device is away; it is reopened on the next command."""
+        return self._session
+
+    @staticmethod
+    def _exchange(sdev, write, splitter=None):
+        """Send 'write' to an open port, return lines as array. The reply ends
+           with its known final line (see REPLY_END) or a read timeout."""
+        return DigiDog._exchange_batch(sdev, write, [DigiDog.REPLY_END.get(write)], splitter)[0]
+
+    @staticmethod
+    def _exchange_batch(sdev, write, ends, splitter=None):
+        """Send 'write' to an open port and split the reply into one list of
+           lines per entry of 'ends'. A reply is complete when a line starts
+           with any of its entry; an entry of None is read until timeout.
+           The lines are split by 'splitter', which counts the bad ones."""
+        sdev.reset_input_buffer()
+        sdev.write(write.encode("ascii"))
+        replies = [[] for end in ends]
+        index = 0
+        for line in DigiDog._read_lines(sdev, DigiDog.MAX_REPLY * len(ends), splitter):
+            replies[index].append(line)
+            if ends[index] is not None and line.startswith(ends[index]):
+                index += 1
+                if index == len(ends):
+                    break
+        return replies
+
+    @staticmethod
+    def _read_lines(sdev, limit, splitter=None):
+        """Yield the lines read from an open port until it times out or 'limit'
+           bytes were read. Reads what is waiting in chunks of READ_CHUNK and
+           splits it with a LineSplitter, so memory stays bounded as well."""
+        if splitter is None:
+            splitter = LineSplitter()
+        while limit > 0:
+            chunk = sdev.read(min(sdev.in_waiting, DigiDog.READ_CHUNK, limit) or 1)
+            if not chunk:
+                break
+            limit -= len(chunk)
+            for line in splitter.feed(chunk):
+                yield line
+        line = splitter.flush()
+        if line:
+            yield line
+
+    def _with_port(self, exchange, *args):
+        """Run 'exchange' with an open port as first argument and return its result.
+           Within a session the open port is reused. If it fails, it is opened
+           once more and the exchange is retried before the error is raised."""
+        if not self._session:
+            with self._open_port() as sdev:
+                return exchange(sdev, *args)
+        try:
+            self.open()
+            return exchange(self._sdev, *args)
+        except _port_errors():
+            # If this fails as well, the port stays closed and the next
+            # command tries to open it again.
+            if self.metrics is not None:
+                self.metrics.observe_reconnect(self._device)
+            self.reopen()
+            return exchange(self._sdev, *args)
+
+    def _communicate(self, write):
+        """Communicate with the device. Send 'write', return lines as array."""
+        splitter = LineSplitter()
+        try:
+            return self._with_port(DigiDog._exchange, write, splitter)
+        finally:
+            self._count_lines(splitter.dropped, splitter.malformed)
+
+    def command(self, command):
+        """Send command to device, return results as dict of lists."""
+        return self._command(command)[1]
+
+    def _command(self, command):
+        """Send command to device, return the reply lines and the results."""
+        started = monotonic()
+        lines = self._communicate(command)
+        results = parse_lines(lines)
+        self._update_capabilities(command, results)
+        if self.metrics is not None:
+            self.metrics.observe_exchange(self._device, [command], [lines], monotonic() - started)
+            self.metrics.observe_results(self._device, results)
+        return lines, results
+
+    def batch(self, commands):
+        """Send several commands in one write and return a list with the results
+           of each command, as command() would. All but the last command need a
+           known reply shape (see REPLY_END) to split the replies."""
+        commands = list(commands)
+        if not commands:
+            return []
+        ends = DigiDog._batch_ends(commands)
+        started = monotonic()
+        splitter = LineSplitter()
+        try:
+            replies = self._with_port(DigiDog._exchange_batch, "".join(commands), ends, splitter)
+        finally:
+            self._count_lines(splitter.dropped, splitter.malformed)
+        if self.metrics is not None:
+            self.metrics.observe_exchange(self._device, commands, replies, monotonic() - started)
+        batch_results = []
+        for command, lines in zip(commands, replies):
+            results = parse_lines(lines)
+            self._update_capabilities(command, results)
+            if self.metrics is not None:
+                self.metrics.observe_results(self._device, results)
+            batch_results.append(results)
+        return batch_results
+
+    @staticmethod
+    def _batch_ends(commands):
+        """Return the reply ends for a list of commands sent at once."""
+        ends = []
+        for index, command in enumerate(commands):
+            end = DigiDog.REPLY_END.get(command)
+            if end is None and index < len(commands) - 1:
+                raise ValueError("Reply to command '{}' can not be separated from the following ones.".format(command))
+            ends.append(end)
+        return ends
+
+    def refresh_capabilities(self):
+        """Read version information and blocked commands from the device again."""
+        self.invalidate_capabilities()
+        self.version_info()
+        self.blocked_commands()
+
+    def version_info(self):
+        """Return the parsed reply to 'V'. It is read from the device once and
+           cached until the device reconnects or reports another serial."""
+        if self._version_info is None:
+            self.command("V")
+        return self._version_info or {}
+
+    def version(self):
+        """Return version number."""
+        results = self.version_info()
+        if "device.version" in results:
+            return int(results["device.version"][-1])
+        else:
+            return 0
+
+    def command_with_version(self, command, version=2):
+        """Execute command with if version >= $version."""
+        device_version = self.version()
+        if device_version >= int(version):
+            return self.command(command)
+        else:
+            raise VersionMismatch("Version requested ({}) was not met by device ({}) - Command '{}'".format(version, device_version, command))
+
+    def blocked_commands(self):
+        """Return list of blocked commands on device as list of characters.
+           The list is cached like the version information."""
+        if self._blocked is None:
+            results = self.command_with_version("Q", 2)
+            if self._blocked is None:
+                return CapabilityCache._blocked_from_results(results)
+        return list(self._blocked)
+
+    def arm(self):
+        """Arm timer by starting it. It may be disallowed to stop it again depending on firmware configuration."""
+        results = self.command("X")
+        return results
+
+    def disarm(self):
+        """Disarm timer, if it is allowed."""
+        results = self.command("x")
+        if "command.blocked" in results and "x" in results["command.blocked"]:
+            raise CommandBlocked("Could not disarm timer because it was not allowed.")
+        if "command.executed" in results and "x" in results["command.executed"]:
+            return True
+
+    def trigger(self):
+        """Trigger a timer reset to keep the device alive."""
+        if self.get_timer_armed():
+            results = self.command("R")
+            return results
+        else:
+            raise CommandNotSensibleInThisState("Timer is not running. It does not make any sense to trigger it.")
+
+    def timer_up(self):
+        """Increase the timer interval."""
+        results = self.command_with_version("+", 2)
+        if "command.blocked" in results and "+" in results["command.blocked"]:
+            raise CommandBlocked("Timer can not be adjusted.")
+        return results["timer.start"]
+
+    def timer_down(self):
+        """Increase the timer interval."""
+        results = self.command_with_version("-", 2)
+        if "command.blocked" in results and "-" in results["command.blocked"]:
+            raise CommandBlocked("Timer can not be adjusted.")
+        return results["timer.start"]
+
+    def set_timer(self, value):
+        """Try to set timer to a defined value. If the value can not be met accurately,
+           the timer will be set to a value just above it. If the timer can not be set
+           to a value high enough, it is set to the highest value possible. The new timer
+           value is returned.
+           The presses of '+' or '-' needed are computed from the current timer value and
+           sent in writes of up to TIMER_CHUNK. The value after each write is checked; if it
+           is not the expected one (e.g. the firmware uses other limits), the timer is
+           adjusted step by step."""
+        blocked = self.blocked_commands()
+        if value <= 0 or value >=65535:
+            raise ValueError("Requested timer value of '{}' implausible. Sensible values are from 0 to 65535".format(value))
+        timer = self.get_timer_start()
+        presses, expected = DigiDog.plan_timer(timer, value)
+        if not presses:
+            return timer
+        if presses[0] in blocked:
+            raise CommandBlocked("Timer can not be adjusted.")
+        for chunk, expected in DigiDog.timer_chunks(timer, presses):
+            timer = self.batch(chunk)[-1].get("timer.start")
+            if timer != expected:
+                return self._walk_timer(self.get_timer_start(), value)
+        return timer
+
+    def set_timer_seconds(self, seconds):
+        """Set the timer to last at least 'seconds', see set_timer(). The
+           seconds the timer set lasts are returned."""
+        return self.seconds(self.set_timer(self.ticks(seconds)))
+
+    def ticks(self, seconds):
+        """Timer ticks that take at least 'seconds' on this device."""
+        return int(math.ceil(round(seconds * self.ticks_per_second, 6)))
+
+    def seconds(self, ticks):
+        """Seconds 'ticks' of the timer take on this device."""
+        return ticks / self.ticks_per_second
+
+    @staticmethod
+    def plan_timer(current, value):
+        """Return the presses of '+' or '-' needed to move the timer from 'current'
+           to the lowest value not below 'value' (or the highest value possible) and
+           the timer value expected afterwards, following the firmware's steps and
+           limits."""
+        step = DigiDog.TIMER_SET_STEP
+        if value > current:
+            target = min(value, DigiDog.TIMER_SET_MAX)
+            count = -(-(target - current) // step)
+            return "+" * count, min(current + count * step, DigiDog.TIMER_SET_MAX)
+        if value <= DigiDog.TIMER_SET_MIN:
+            # Pressing past the minimum clamps to it.
+            count = -(-(current - DigiDog.TIMER_SET_MIN) // step)
+            return "-" * count, DigiDog.TIMER_SET_MIN
+        count = (current - value) // step
+        return "-" * count, current - count * step
+
+    @staticmethod
+    def timer_chunks(current, presses):
+        """Split the presses of plan_timer() into writes of up to TIMER_CHUNK and
+           return them as a list of (presses, timer value expected afterwards)."""
+        step = DigiDog.TIMER_SET_STEP if presses[:1] == "+" else -DigiDog.TIMER_SET_STEP
+        chunks = []
+        for start in range(0, len(presses), DigiDog.TIMER_CHUNK):
+            chunk = presses[start:start + DigiDog.TIMER_CHUNK]
+            current = min(max(current + step * len(chunk), DigiDog.TIMER_SET_MIN), DigiDog.TIMER_SET_MAX)
+            chunks.append((chunk, current))
+        return chunks
+
+    def _walk_timer(self, timer, value):
+        """Move the timer towards value one step at a time, see set_timer()."""
+        over = False
+        under = False
+        timer_set = False
+        last = timer
+        while not timer_set:
+            # Save old timer value to see if it was modified
+            last = timer
+            if timer > value:
+                # If timer is over requested value, decrease timer
+                timer = self.timer_down()
+                # If timer is now below max, set low tide flag, reset high tide flag
+                if timer < value:
+                    under = True
+                    over = False
+            elif timer < value:
+                # If timer is under requested value, increase timer
+                timer = self.timer_up()
+                # If timer is now above max, set high tide flag, reset low tide flag
+                if timer > value:
+                    under = False
+                    over = True
+            if last == timer:
+                timer_set = True
+            if timer == value:
+                timer_set = True
+            if over and not under:
+                timer_set = True
+        return timer
+
+    def apply_config(self, desired, persist=True):
+        """Bring the configuration to 'desired', a dict with "timer.start" and/or
+           "target.recovery-method" ("reset" or "power") as in the results of
+           get_config(), and return the configuration read back.
+           The configuration is read once and only the commands needed are sent,
+           the last of them in one write together with the 'C' to verify them
+           (timer presses go in writes of up to TIMER_CHUNK). If anything
+           changed and 'persist' is set, it is written to the EEPROM with a
+           single '>'. Nothing is written if the device already had the values,
+           even if they were never saved. ConfigMismatch is raised, without
+           saving, if the device does not report the values expected."""
+        unknown = set(desired) - set(("timer.start", "target.recovery-method"))
+        if unknown:
+            raise ValueError("Can not apply '{}'".format("', '".join(sorted(unknown))))
+        config = self.get_config()
+        presses = ""
+        switch = ""
+        expected = {}
+        if "timer.start" in desired:
+            value = desired["timer.start"]
+            if value <= 0 or value >=65535:
+                raise ValueError("Requested timer value of '{}' implausible. Sensible values are from 0 to 65535".format(value))
+            presses, expected["timer.start"] = DigiDog.plan_timer(config["timer.start"], value)
+        method = desired.get("target.recovery-method")
+        if method is not None:
+            if method not in DigiDog.RECOVERY_METHODS:
+                raise ValueError("Unknown recovery method '{}'. Known are 'reset' and 'power'".format(method))
+            expected["target.recovery-method"] = method
+            if config.get("target.recovery-method") != method:
+                switch = DigiDog.RECOVERY_METHODS[method]
+        commands = presses + switch
+        if not commands:
+            return config
+        blocked = set(self.blocked_commands())
+        if blocked & set(commands) & set("+-"):
+            raise CommandBlocked("Timer can not be adjusted.")
+        if blocked & set(commands) & set("mM"):
+            raise CommandBlocked("Recovery method can not be changed.")
+        if persist and ">" in blocked:
+            raise CommandBlocked("Configuration can not be saved.")
+        chunks = DigiDog.timer_chunks(config["timer.start"], presses) if presses else [("", None)]
+        for chunk, timer in chunks[:-1]:
+            reported = self.batch(chunk)[-1].get("timer.start")
+            if reported != timer:
+                raise ConfigMismatch("Device reports timer.start {!r} instead of {!r}".format(reported, timer))
+        config = self.batch(chunks[-1][0] + switch + "C")[-1]
+        for name, value in sorted(expected.items()):
+            if config.get(name) != value:
+                raise ConfigMismatch("Device reports {} {!r} instead of {!r}".format(name, config.get(name), value))
+        if persist and "command.executed" not in self.eeprom_save():
+            raise CommandBlocked("Configuration can not be saved.")
+        return config
+
+    def get_timer_start(self):
+        """Request timer start value."""
+        return self.get_status()["timer.start"]
+
+    def get_timer_current(self):
+        """Request current timer value."""
+        return self.get_status()["timer.current"]
+
+    def get_timer_armed(self):
+        """Request current timer value."""
+        return self.get_status()["timer.armed"]
+
+    def get_config(self):
+        """Fetch configuration from device"""
+        return self.command_with_version("C", 2)
+
+    def get_status(self):
+        """Fetch operational status from device"""
+        return self.command_with_version("S", 2)
+
+    def eeprom_save(self):
+        """Write values to EEPROM if allowed"""
+        results = self.command_with_version(">", 2)
+        return results
+
+    def eeprom_restore(self):
+        """Read values from EEPROM and reset counters - if allowed.
+           TODO: Check if fired counter can be reject."""
+        results = self.command_with_version("<", 2)
+        return results
+
+    def reinit_usb(self):
+        """Make the device reinitialise its USB stack and I/O ports ('!'). It
+           does not answer and may disappear from the bus for a moment."""
+        self._communicate("!")
+
+    def lock(self):
+        """Set timer lock if supported."""
+        results = self.command_with_version("L", 2)
+        if "command.blocked" in results and "L" in results["command.blocked"]:
+            raise CommandBlocked("Cannot lock Timer. Command blocked.")
+        if "command.executed" in results and "L" in results["command.executed"]:
+            return True
+        else:
+            return False
+
+
+class KeepaliveScheduler(object):
+    """Decide when the next trigger is due from the countdown (C:) observed
+       on the device and the measured round trip time of the exchanges.
+       The trigger is sent as late as possible while keeping 'margin' (a
+       fraction of the countdown) and 'jitter' seconds in reserve."""
+
+    TICKS_PER_SECOND = DigiDog.TICKS_PER_SECOND
+    # Number of recent round trip times the slowest one is taken from.
+    RTT_SAMPLES = 16
+
+    def __init__(self, margin=0.2, jitter=1.0, min_delay=1.0, ticks_per_second=None):
+        self.margin = margin
+        self.jitter = jitter
+        self.min_delay = min_delay
+        self.ticks_per_second = ticks_per_second or KeepaliveScheduler.TICKS_PER_SECOND
+        self._rtts = collections.deque(maxlen=KeepaliveScheduler.RTT_SAMPLES)
+        self._expiry = None
+        self._span = 0.0
+
+    @property
+    def rtt(self):
+        """Slowest recent round trip time in seconds."""
+        return max(self._rtts) if self._rtts else 0.0
+
+    def observe(self, ticks, at=None, rtt=0.0):
+        """Record the countdown 'ticks' read in an exchange that took 'rtt' seconds
+           and ended at monotonic time 'at'. After a trigger, pass the timer
+           start value. The value is assumed to be read at the start of the
+           exchange, which errs on the early side."""
+        if at is None:
+            at = monotonic()
+        self._rtts.append(rtt)
+        self._span = ticks / self.ticks_per_second
+        self._expiry = at - rtt + self._span
+
+    def remaining(self, now=None):
+        """Estimated seconds until the device fires, None if nothing was observed."""
+        if self._expiry is None:
+            return None
+        return self._expiry - (monotonic() if now is None else now)
+
+    def budget(self, now=None):
+        """Seconds that may pass before the next trigger is sent without the
+           device firing, keeping 'jitter' and the round trip time in reserve."""
+        remaining = self.remaining(now)
+        if remaining is None:
+            return 0.0
+        return max(remaining - self.jitter - self.rtt, 0.0)
+
+    def deadline(self):
+        """Monotonic time by which the next trigger has to be sent."""
+        if self._expiry is None:
+            return monotonic()
+        return self._expiry - self.margin * self._span - self.jitter - self.rtt
+
+    def delay(self):
+        """Seconds to wait before the next trigger, at least 'min_delay'."""
+        return max(self.deadline() - monotonic(), self.min_delay)
@@ -0,0 +1,267 @@
+# Keepalive daemon for all DigiDogs of a host
+#
+# Usage: digidog daemon [config]
+#
+# The configuration file is optional and maps device serials (as reported
+# in O: by 'V') to their settings. Values in [DEFAULT] apply to all devices:
+#
+#   [DEFAULT]
+#   ports = /dev/ttyACM*
+#   timer = 1200
+#
+#   [10000002]
+#   timer = 3000
+#   interval = 30
+#
+# Without an interval, a device is triggered as late as its countdown
+# allows while keeping 'margin' (fraction of the timer) and 'jitter'
+# (seconds) in reserve. The countdown is converted to seconds with the
+# rate of the device in the 'calibration' file written by "digidog
+# calibrate", 10 ticks per second for devices not calibrated.
+#
+# Keepalive metrics are served on 127.0.0.1:'metrics-port' and/or written
+# to 'metrics-file' every 'metrics-interval' seconds if these are set in
+# [DEFAULT].
+#
+# If the file lists any device, only those are served. Otherwise every
+# DigiDog found is served with the default settings.
+#
+# Triggers can be gated by health checks of the host (see digidog.health):
+#
+#   check-command = systemctl is-active --quiet nginx
+#   check-file = /run/app/heartbeat 120
+#   check-tcp = 80 443
+#   check-process = sshd /run/crond.pid
+#
+# check-command and check-file take one command or "path max-age" per
+# line; check-tcp takes local ports and check-process takes process names
+# or pid files. Each check may take 'check-timeout' seconds and its result
+# is reused for 'check-ttl' seconds. Once a check failed for longer than
+# 'check-grace' seconds, the device is no longer triggered. Devices with
+# the same checks share one gate, so each check runs once for all of them.
+#
+# A device that stops answering is recovered by reopening its port,
+# reinitialising its USB stack, waiting for it to come back and searching
+# 'ports' for its serial, within the time left on its countdown (see
+# digidog.recovery).
+#
+# With 'journal' set in [DEFAULT], status changes and trigger round trip
+# times are appended to that file, which is rotated at 'journal-size'
+# bytes keeping 'journal-backups' compressed files (see digidog.journal).
+#
+# With 'socket' set in [DEFAULT], other processes reach the devices through
+# the daemon on that Unix domain socket (see digidog.broker). Status and
+# config replies up to 'socket-max-age' seconds old are served from cache.
+#
+# With 'capture' set in [DEFAULT], the serial traffic of every device is
+# recorded (see digidog.capture). The last 'capture-size' bytes of each
+# device are saved to 'capture' with the device serial appended (e.g.
+# /var/tmp/digidog.cap.10000002) every 'capture-interval' seconds and
+# when the daemon stops.
+
+import asyncio
+import configparser
+import glob
+import sys
+
+from .aio import AsyncDigiDog, AsyncSerialPort, AsyncSupervisor, discover
+from .broker import Broker
+from .calibration import CALIBRATION_FILE, CalibrationCache
+from .capture import CaptureLog, Recorder
+from .client import KeepaliveScheduler
+from .health import CommandCheck, FileAgeCheck, HealthGate, ProcessCheck, TcpCheck
+from .journal import Journal
+from .metrics import Metrics, Observers
+from .recovery import Recovery
+
+DEFAULTS = {
+    "ports": "/dev/ttyACM*",
+    "timer": "1200",
+    "probe-timeout": "1.0",
+    "margin": "0.2",
+    "jitter": "1.0",
+    "calibration": CALIBRATION_FILE,
+    "metrics-port": "",
+    "metrics-file": "",
+    "metrics-interval": "15",
+    "journal": "",
+    "journal-size": "1048576",
+    "journal-backups": "5",
+    "socket": "",
+    "socket-mode": "660",
+    "socket-max-age": "1.0",
+    "capture": "",
+    "capture-size": "1048576",
+    "capture-interval": "60",
+    "check-command": "",
+    "check-file": "",
+    "check-tcp": "",
+    "check-process": "",
+    "check-timeout": "5",
+    "check-ttl": "10",
+    "check-grace": "60",
+}
+
+
+def read_config(path=None):
+    """Read the daemon configuration, falling back to the defaults."""
+    config = configparser.ConfigParser(defaults=DEFAULTS)
+    if path is not None:
+        with open(path) as config_file:
+            config.read_file(config_file)
+    return config
+
+
+def candidate_ports(patterns):
+    """Return the ports matching any of the whitespace separated glob patterns."""
+    ports = []
+    for pattern in patterns.split():
+        ports.extend(port for port in sorted(glob.glob(pattern)) if port not in ports)
+    return ports
+
+
+def health_gate(config, section, gates=None):
+    """Return the HealthGate configured in a section, None if it has no checks.
+       'gates' caches the gates by their settings to share them."""
+    key = tuple(config.get(section, option) for option in (
+        "check-command", "check-file", "check-tcp", "check-process", "check-timeout", "check-ttl", "check-grace"))
+    if gates is not None and key in gates:
+        return gates[key]
+    options = {"timeout": config.getfloat(section, "check-timeout"),
+               "ttl": config.getfloat(section, "check-ttl")}
+    checks = [CommandCheck(command, **options)
+              for command in config.get(section, "check-command").splitlines() if command.strip()]
+    for line in config.get(section, "check-file").splitlines():
+        if line.strip():
+            path, max_age = line.rsplit(None, 1)
+            checks.append(FileAgeCheck(path, float(max_age), **options))
+    checks.extend(TcpCheck(port, **options) for port in config.get(section, "check-tcp").split())
+    checks.extend(ProcessCheck(process, **options) for process in config.get(section, "check-process").split())
+    gate = HealthGate(checks, grace=config.getfloat(section, "check-grace")) if checks else None
+    if gates is not None:
+        gates[key] = gate
+    return gate
+
+
+def device_settings(config, section, ticks_per_second=None, gates=None):
+    """Return timer, trigger interval, scheduler and health gate configured in
+       the section of a device. An interval of None leaves it to the
+       scheduler, a gate of None triggers unconditionally. 'gates' is passed
+       on to health_gate()."""
+    section = section if config.has_section(section) else "DEFAULT"
+    interval = config.get(section, "interval", fallback=None)
+    scheduler = KeepaliveScheduler(margin=config.getfloat(section, "margin"),
+                                   jitter=config.getfloat(section, "jitter"),
+                                   ticks_per_second=ticks_per_second)
+    return (config.getint(section, "timer"), float(interval) if interval else None, scheduler,
+            health_gate(config, section, gates))
+
+
+async def write_metrics(metrics, path, interval):
+    """Write the metrics to 'path' every 'interval' seconds until cancelled."""
+    while True:
+        try:
+            metrics.write_file(path)
+        except (IOError, OSError) as e:
+            print("Could not write metrics to {} due to exception: {}".format(path, e))
+        await asyncio.sleep(interval)
+
+
+def save_captures(captures):
+    """Save the capture logs, a dict of path to CaptureLog."""
+    for path, log in sorted(captures.items()):
+        try:
+            log.save(path)
+        except (IOError, OSError) as e:
+            print("Could not write capture to {} due to exception: {}".format(path, e))
+
+
+async def write_captures(captures, interval):
+    """Save the capture logs every 'interval' seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        save_captures(captures)
+
+
+async def run(config):
+    """Find the DigiDogs of this host and keep them alive until cancelled."""
+    wanted = [section.upper() for section in config.sections()]
+    found = await discover(candidate_ports(config.get("DEFAULT", "ports")),
+                           config.getfloat("DEFAULT", "probe-timeout"))
+    calibration = CalibrationCache(config.get("DEFAULT", "calibration"))
+    metrics = Metrics()
+    journal = None
+    if config.get("DEFAULT", "journal"):
+        journal = Journal(config.get("DEFAULT", "journal"), config.getint("DEFAULT", "journal-size"),
+                          config.getint("DEFAULT", "journal-backups"))
+    supervisor = AsyncSupervisor(recovery=Recovery(lambda: candidate_ports(config.get("DEFAULT", "ports")),
+                                                   config.getfloat("DEFAULT", "probe-timeout")))
+    broker = None
+    if config.get("DEFAULT", "socket"):
+        # Filled below; it also observes the devices to cache their replies.
+        broker = Broker({}, supervisor, config.getfloat("DEFAULT", "socket-max-age"))
+    captures = {}
+    gates = {}
+    for device_serial, dev in sorted(found.items()):
+        if wanted and device_serial not in wanted:
+            print("{}: Ignoring DigiDog {} as it is not configured".format(dev.device, device_serial))
+            dev.close()
+            continue
+        if config.get("DEFAULT", "capture"):
+            # Record from the start of the session the supervisor opens.
+            log = CaptureLog(config.getint("DEFAULT", "capture-size"))
+            captures["{}.{}".format(config.get("DEFAULT", "capture"), device_serial)] = log
+            dev.close()
+            dev = AsyncDigiDog(dev.device, transport=Recorder(log, AsyncSerialPort.open_serial))
+        section = next((name for name in config.sections() if name.upper() == device_serial), device_serial)
+        rate = calibration.get(device_serial)
+        timer, interval, scheduler, health = device_settings(config, section, rate, gates)
+        print("{}: Serving DigiDog {} with timer {} at {} ticks per second".format(
+            dev.device, device_serial, timer, scheduler.ticks_per_second))
+        observers = [metrics]
+        if rate is not None:
+            metrics.ticks_per_second[dev.device] = rate
+        if journal is not None:
+            journal.names[dev.device] = device_serial
+            if rate is not None:
+                journal.ticks_per_second[dev.device] = rate
+            observers.append(journal)
+        if broker is not None:
+            broker.devices[device_serial] = dev
+            observers.append(broker)
+        dev.metrics = Observers(*observers) if len(observers) > 1 else metrics
+        supervisor.add(dev, timer, interval, scheduler, health)
+    for device_serial in wanted:
+        if device_serial not in found:
+            print("Configured DigiDog {} was not found".format(device_serial))
+    if not supervisor.devices:
+        print("No DigiDog to serve")
+        return 1
+    tasks = [supervisor.run()]
+    if config.get("DEFAULT", "metrics-port"):
+        metrics.serve(config.getint("DEFAULT", "metrics-port"))
+    if config.get("DEFAULT", "metrics-file"):
+        tasks.append(write_metrics(metrics, config.get("DEFAULT", "metrics-file"),
+                                   config.getfloat("DEFAULT", "metrics-interval")))
+    if captures:
+        tasks.append(write_captures(captures, config.getfloat("DEFAULT", "capture-interval")))
+    if broker is not None:
+        tasks.append(broker.serve(config.get("DEFAULT", "socket"), int(config.get("DEFAULT", "socket-mode"), 8)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # After the devices were disarmed
+        save_captures(captures)
+    return 0
+
+
+def main(argv):
+    config = read_config(argv[1] if len(argv) > 1 else None)
+    try:
+        return asyncio.run(run(config))
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
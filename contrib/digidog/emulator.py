@@ -0,0 +1,505 @@
+# Software DigiDog behind a pseudo-terminal
+#
+# Usage: python3 -m digidog.emulator [count] [eeprom directory]
+#
+# Firmware implements the command switch of loop() in DigiDog_SLCPv1.cpp
+# and the output functions of DigiDog_output.cpp. The settings are read
+# from DigiDog_config.h, so the emulator follows the configured ALLOW_*
+# switches and limits. Emulator puts a Firmware behind a pty whose slave
+# path can be opened like /dev/ttyACM0. EmulatorHost serves any number of
+# emulators from one thread.
+#
+# Like the device, each loop() pass takes at most the bytes the DigiCDC
+# input buffer holds (Emulator.INPUT_BUFFER), so a long write trickles in
+# over several passes.
+#
+# Two details of the firmware source are interpreted: loop() has two
+# "case 'x'" labels, the first one answering "Q:L", which is taken as the
+# lock command 'L'. Nothing in the firmware sets the lock, so it stays off.
+
+import json
+import os
+import random
+import re
+import selectors
+import sys
+import threading
+import time
+import tty
+
+CONFIG_H = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                        "DigiDog_config.h")
+
+# Used if DigiDog_config.h can not be read
+DEFAULT_CONFIG = {
+    "ROM_TIMER_START": 1200,
+    "POWER_CYCLE_ON_TIMEOUT": 0,
+    "ALLOW_RECOVERY_MODE_CHANGE": True,
+    "ALLOW_TIMER_CHANGE": True,
+    "ALLOW_EEPROM_UPDATE": True,
+    "LED": 1,
+    "RESET": 0,
+    "POWER": 2,
+    "RESET_TIME": 1000,
+    "RESET_LINE_ON": 0,
+    "RESET_LINE_OFF": 1,
+    "POWER_OFF_TIME": 5000,
+    "POWER_SLEEP_TIME": 2000,
+    "POWER_ON_TIME": 1000,
+    "POWER_LINE_ON": 0,
+    "POWER_LINE_OFF": 1,
+    "INTERNAL_WATCHDOG_START": 18000,
+    "REBOOT_AFTER_PRESSES": 3,
+    "TIMER_SET_STEP": 100,
+    "TIMER_SET_MIN": 100,
+    "TIMER_SET_MAX": 65000,
+    "EEPROM_MAGIC": 0xdd09,
+    "EEPROM_VERSION": 1,
+    "VERSION": 2,
+    "UNIT_ID": 1,
+    "DEVICE_SERIAL": 0x10000002,
+}
+
+LEVELS = {"LOW": 0, "HIGH": 1}
+
+
+def read_config(path=CONFIG_H):
+    """Return the #defines of DigiDog_config.h. Switches without a value are True."""
+    try:
+        with open(path) as config_file:
+            text = config_file.read()
+    except (IOError, OSError):
+        return dict(DEFAULT_CONFIG)
+    config = {}
+    for name, value in re.findall(r"^[ \t]*#define[ \t]+(\w+)[ \t]*([^\s/]*)", text, re.M):
+        if not value:
+            config[name] = True
+        elif value in LEVELS:
+            config[name] = LEVELS[value]
+        else:
+            try:
+                config[name] = int(value, 0)
+            except ValueError:
+                config[name] = value
+    return config
+
+
+class Firmware(object):
+    """State and command handling of one DigiDog. handle() takes one input
+       byte and returns the output, tick() runs the rest of one loop() pass
+       and returns the seconds the device is busy beyond the usual delay."""
+
+    def __init__(self, config=None, eeprom_path=None, serial=None):
+        self.config = config or read_config()
+        self.eeprom_path = eeprom_path
+        self.serial = self.config["DEVICE_SERIAL"] if serial is None else serial
+        self.eeprom_writes = 0
+        self.reboots = 0
+        self.resets = 0
+        self.power_cycles = 0
+        self.eeprom = None
+        self._flash = None
+        self.setup()
+
+    def allowed(self, switch):
+        return bool(self.config.get(switch))
+
+    # DigiDog_EEPROM.cpp
+
+    def init_eeprom(self):
+        config = self.config
+        eeprom = {
+            "magic": config["EEPROM_MAGIC"],
+            "version": config["EEPROM_VERSION"],
+            "fired_counter": 0,
+            "timer_start": config["ROM_TIMER_START"],
+            "power_cycle_on_timeout": config["POWER_CYCLE_ON_TIMEOUT"],
+            "serial": self.serial,
+        }
+        self._put_eeprom(eeprom)
+        return eeprom
+
+    def read_eeprom(self):
+        eeprom = None
+        if self.eeprom_path is not None:
+            try:
+                with open(self.eeprom_path) as eeprom_file:
+                    eeprom = json.load(eeprom_file)
+            except (IOError, OSError, ValueError):
+                eeprom = None
+        elif self._flash is not None:
+            eeprom = dict(self._flash)
+        if eeprom and eeprom.get("magic") == self.config["EEPROM_MAGIC"] \
+                and eeprom.get("version") == self.config["EEPROM_VERSION"]:
+            return eeprom
+        return self.init_eeprom()
+
+    def update_eeprom(self):
+        self._put_eeprom(self.eeprom)
+
+    def _put_eeprom(self, eeprom):
+        self.eeprom_writes += 1
+        self._flash = dict(eeprom)
+        if self.eeprom_path is not None:
+            temp = self.eeprom_path + ".tmp"
+            with open(temp, "w") as eeprom_file:
+                json.dump(eeprom, eeprom_file)
+            os.rename(temp, self.eeprom_path)
+
+    # DigiDog_SLCPv1.cpp
+
+    def setup(self):
+        self.eeprom = self.read_eeprom()
+        self.armed = 0
+        self.fired = 0
+        self.locked = 0
+        self.int_wdt = self.config["INTERNAL_WATCHDOG_START"]
+        self.timer = self.eeprom["timer_start"]
+        self.reboot_in = self.config["REBOOT_AFTER_PRESSES"]
+
+    def sanitize_timer(self):
+        if self.eeprom["timer_start"] < self.config["TIMER_SET_MIN"]:
+            self.eeprom["timer_start"] = self.config["TIMER_SET_MIN"]
+        if self.eeprom["timer_start"] >= self.config["TIMER_SET_MAX"]:
+            self.eeprom["timer_start"] = self.config["TIMER_SET_MAX"]
+
+    def reset_timer(self):
+        if self.armed > 0:
+            self.timer = self.eeprom["timer_start"]
+
+    # DigiDog_output.cpp
+
+    def status(self):
+        return "C:{}\r\nS:{}\r\nA:{}\r\nF:{}\r\nJ:{}\r\nL:{}\r\n#:{}\r\n".format(
+            self.timer, self.eeprom["timer_start"], self.armed, self.fired, self.locked,
+            self.eeprom["fired_counter"], self.reboot_in)
+
+    def config_output(self):
+        c = self.config
+        return ("T:{}\r\nS:{}\r\nK:{}\r\nM:{}\r\nN:{}\r\nH:{},{},{}\r\nI:{},{} {},{}\r\n"
+                "Z:{},{},{}\r\nR:{}\r\n").format(
+            c["ROM_TIMER_START"], self.eeprom["timer_start"], self.int_wdt, c["POWER_CYCLE_ON_TIMEOUT"],
+            self.eeprom["power_cycle_on_timeout"], c["RESET"], c["POWER"], c["LED"],
+            c["RESET_LINE_ON"], c["RESET_LINE_OFF"], c["POWER_LINE_ON"], c["POWER_LINE_OFF"],
+            c["POWER_OFF_TIME"], c["POWER_SLEEP_TIME"], c["POWER_ON_TIME"], c["RESET_TIME"])
+
+    def version(self):
+        return "V:{}\r\nU:{}\r\nO:{:X}\r\n".format(self.config["VERSION"], self.config["UNIT_ID"], self.eeprom["serial"])
+
+    def blocked(self):
+        out = []
+        if not self.allowed("ALLOW_TIMER_CHANGE"):
+            out += ["-", "+"]
+        if not self.allowed("ALLOW_DEBUG"):
+            out += ["F", "P", "#"]
+        if not self.allowed("ALLOW_RECOVERY_MODE_CHANGE"):
+            out += ["m", "M"]
+        if not self.allowed("ALLOW_FIRED_COUNTER_RESET"):
+            out += ["0"]
+        if not self.allowed("ALLOW_TIMER_STOP") and self.locked:
+            out += ["x"]
+        if not self.allowed("ALLOW_EEPROM_UPDATE"):
+            out += [">"]
+        out += ["Q"]
+        return "".join("Q:{}\r\n".format(command) for command in out)
+
+    def handle(self, input):
+        """Handle one input byte as loop() does and return the output."""
+        command = chr(input)
+        config = self.config
+        out = ""
+        if command != "#":
+            self.reboot_in = config["REBOOT_AFTER_PRESSES"]
+        if command == "F":
+            if self.allowed("ALLOW_DEBUG"):
+                out = "W:RST\r\n"
+                self.resets += 1
+            else:
+                out = "Q:F\r\n"
+        elif command == "P":
+            if self.allowed("ALLOW_DEBUG"):
+                out = "W:PWR\r\n"
+                self.power_cycles += 1
+            else:
+                out = "Q:P\r\n"
+        elif command == "#":
+            if self.allowed("ALLOW_DEBUG_WATCHDOG_REBOOT"):
+                if self.reboot_in <= 1:
+                    self.reboots += 1
+                    self.setup()
+                else:
+                    self.reboot_in -= 1
+                    out = "#:{}\r\n".format(self.reboot_in)
+            else:
+                out = "Q:#\r\n"
+        elif command == "!":
+            pass
+        elif command == "<":
+            old_fired_counter = self.eeprom["fired_counter"]
+            self.eeprom = self.init_eeprom()
+            self.reset_timer()
+            if not self.allowed("ALLOW_FIRED_COUNTER_RESET"):
+                self.eeprom["fired_counter"] = old_fired_counter
+                self.update_eeprom()
+            out = "P:<\r\n" + self.config_output() + self.status()
+        elif command == ">":
+            if self.allowed("ALLOW_EEPROM_UPDATE"):
+                self.update_eeprom()
+                out = "P:>\r\n"
+            else:
+                out = "Q:>\r\n"
+        elif command == "*":
+            if self.armed > 0:
+                self.timer = config["TIMER_SET_MIN"]
+            out = self.status()
+        elif command == "L":
+            if self.allowed("ALLOW_TIMER_STOP"):
+                self.reset_timer()
+                self.armed = 0
+            else:
+                out = "Q:L\r\n"
+        elif command == "x":
+            if self.locked == 0:
+                self.reset_timer()
+                self.armed = 0
+                self.update_eeprom()
+            else:
+                out = "Q:x\r\n"
+            out += self.status()
+        elif command == "X":
+            self.armed = 1
+            self.reset_timer()
+            self.fired = 0
+            out = self.status()
+        elif command == "R":
+            self.reset_timer()
+            out = "P:R\r\n"
+        elif command == "0":
+            if self.allowed("ALLOW_FIRED_COUNTER_RESET"):
+                self.eeprom["fired_counter"] = 0
+                self.update_eeprom()
+                out = "L:{}\r\n".format(self.eeprom["fired_counter"])
+            else:
+                out = "Q:0\r\n"
+        elif command in "mM":
+            if self.allowed("ALLOW_RECOVERY_MODE_CHANGE"):
+                self.eeprom["power_cycle_on_timeout"] = 1 if command == "M" else 0
+                out = "N:{}\r\n".format(self.eeprom["power_cycle_on_timeout"])
+            else:
+                out = "Q:{}\r\n".format(command)
+        elif command in "+-":
+            if self.allowed("ALLOW_TIMER_CHANGE"):
+                step = config["TIMER_SET_STEP"] if command == "+" else -config["TIMER_SET_STEP"]
+                # unsigned int on the ATtiny
+                self.eeprom["timer_start"] = (self.eeprom["timer_start"] + step) & 0xffff
+                self.sanitize_timer()
+                self.reset_timer()
+                out = "S:{}\r\n".format(self.eeprom["timer_start"])
+            else:
+                out = "Q:{}\r\n".format(command)
+        elif command == "C":
+            out = self.config_output()
+        elif command == "S":
+            out = self.status()
+        elif command == "V":
+            out = self.version()
+        elif command == "Q":
+            out = self.blocked()
+        else:
+            out = "X:{}\r\n".format(input)
+        self.int_wdt = config["INTERNAL_WATCHDOG_START"]
+        return out.encode("ascii")
+
+    def tick(self):
+        """Run the timer part of one loop() pass. Return the seconds a reset
+           or power cycle of the target keeps the device busy."""
+        config = self.config
+        busy = 0.0
+        self.int_wdt = (self.int_wdt - 1) & 0xffff
+        if self.armed > 0:
+            if self.timer == 0:
+                if self.eeprom["power_cycle_on_timeout"] > 0:
+                    self.power_cycles += 1
+                    busy = (config["POWER_OFF_TIME"] + config["POWER_SLEEP_TIME"] + config["POWER_ON_TIME"]) / 1000.0
+                else:
+                    self.resets += 1
+                    busy = config["RESET_TIME"] / 1000.0
+                self.armed = 0
+                self.fired = 1
+                if self.eeprom["fired_counter"] < 65535:
+                    self.eeprom["fired_counter"] += 1
+                    self.update_eeprom()
+            else:
+                self.timer -= 1
+        if self.int_wdt == 0:
+            self.reboots += 1
+            self.setup()
+        return busy
+
+
+class Emulator(object):
+    """A Firmware behind a pseudo-terminal. Open 'port' like the device node
+       of a real DigiDog. Faults can be injected: 'latency' seconds before
+       output is sent, 'loss' as the probability of dropping an output byte
+       and stall() to stop all USB traffic for a while. Each loop() pass
+       handles at most 'input_buffer' bytes, what the input buffer of
+       DigiCDC holds; the rest of a longer write waits for the next passes
+       as the host's USB stack holds it back."""
+
+    # Bytes the DigiCDC input buffer holds
+    INPUT_BUFFER = 32
+
+    def __init__(self, firmware=None, tick=0.1, latency=0.0, loss=0.0, seed=None, input_buffer=None,
+                 **firmware_args):
+        self.firmware = firmware or Firmware(**firmware_args)
+        self.tick = tick
+        self.input_buffer = input_buffer or Emulator.INPUT_BUFFER
+        self.latency = latency
+        self.loss = loss
+        self._random = random.Random(seed)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._input = bytearray()
+        self._output = []
+        self._next_tick = time.monotonic() + tick
+        self._stalled_until = 0.0
+        self.dropped = 0
+
+    def fileno(self):
+        return self._master
+
+    def stall(self, seconds):
+        """Stop reading and writing for 'seconds' as a hung USB stack would."""
+        self._stalled_until = max(self._stalled_until, time.monotonic() + seconds)
+
+    def close(self):
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def read_input(self):
+        """Take the bytes the client wrote."""
+        try:
+            self._input.extend(os.read(self._master, 4096))
+        except (BlockingIOError, OSError):
+            pass
+
+    def deadline(self, now):
+        """Monotonic time this emulator has to be served again."""
+        if self._output:
+            return min(self._next_tick, max(self._output[0][0], self._stalled_until))
+        return self._next_tick
+
+    def step(self, now):
+        """Run the loop() passes and send the output that are due at 'now'.
+           The timer keeps running during a stall, only USB traffic stops."""
+        while now >= self._next_tick:
+            if self._next_tick >= self._stalled_until:
+                output = b""
+                for input in self._input[:self.input_buffer]:
+                    output += self.firmware.handle(input)
+                del self._input[:self.input_buffer]
+                if output:
+                    if self.loss:
+                        kept = bytes(byte for byte in output if self._random.random() >= self.loss)
+                        self.dropped += len(output) - len(kept)
+                        output = kept
+                    self._output.append((self._next_tick + self.latency, output))
+            self._next_tick += self.tick + self.firmware.tick()
+        if now < self._stalled_until:
+            return
+        while self._output and self._output[0][0] <= now:
+            data = self._output.pop(0)[1]
+            try:
+                os.write(self._master, data)
+            except (BlockingIOError, OSError):
+                # Nobody reads; the bytes are lost like in the USB stack.
+                self.dropped += len(data)
+
+
+class EmulatorHost(object):
+    """Serve any number of emulators from one background thread."""
+
+    def __init__(self, emulators=()):
+        self.emulators = []
+        self._added = list(emulators)
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self._running = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add(self, emulator=None, **emulator_args):
+        """Add an emulator (or create one from the arguments) and return it."""
+        emulator = emulator or Emulator(**emulator_args)
+        with self._lock:
+            self._added.append(emulator)
+        os.write(self._wakeup_write, b"\0")
+        return emulator
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        os.write(self._wakeup_write, b"\0")
+        if self._thread is not None:
+            self._thread.join()
+        for emulator in self.emulators + self._added:
+            emulator.close()
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                added, self._added = self._added, []
+            for emulator in added:
+                self._selector.register(emulator, selectors.EVENT_READ)
+                self.emulators.append(emulator)
+            now = time.monotonic()
+            deadline = min([emulator.deadline(now) for emulator in self.emulators] or [now + 1])
+            for key, events in self._selector.select(max(deadline - now, 0)):
+                if key.fileobj == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                else:
+                    key.fileobj.read_input()
+            now = time.monotonic()
+            for emulator in self.emulators:
+                emulator.step(now)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1
+    directory = argv[2] if len(argv) > 2 else None
+    with EmulatorHost() as host:
+        for index in range(count):
+            path = os.path.join(directory, "eeprom{}.json".format(index)) if directory else None
+            emulator = host.add(eeprom_path=path, serial=0x10000000 + index)
+            print(emulator.port)
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,226 @@
+# Change events of the device state
+#
+# A StatusTracker compares each status (the results of get_status()) with
+# the previous one and returns the changes as Events. StatusWatcher polls a
+# DigiDog and passes the events to its subscribers; AsyncStatusWatcher does
+# the same for an AsyncDigiDog and can be iterated with "async for".
+# AsyncSupervisor keeps a watcher per device that does not poll but takes
+# the statuses the keepalive loop reads anyway (AsyncSupervisor.watchers);
+# the daemon passes its events on to subscribers of its socket (see
+# digidog.broker).
+#
+# The watchers poll every 'fast' seconds for 'fast_for' seconds after a
+# change or a call to nudge() (e.g. right after sending a command), and
+# every 'slow' seconds otherwise.
+#
+# F: is only cleared by arming ('X') and by setup() of the firmware. F:
+# cleared with the timer not armed is taken as a reboot of the device, so
+# only reboots after the device fired are seen. Neither K: nor #: can
+# tell: every command resets both to their start values as a reboot does.
+
+import asyncio
+import collections
+import time
+from time import monotonic
+
+ARMED = "armed"
+DISARMED = "disarmed"
+FIRED = "fired"
+LOCKED = "locked"
+UNLOCKED = "unlocked"
+TIMER_START_CHANGED = "timer-start-changed"
+COUNTER_RESET = "counter-reset"
+REBOOTED = "device-rebooted"
+
+
+class Event(object):
+    """A change of the device state. 'old' and 'new' are the values of the
+       field that changed, 'status' is the whole status it was seen in."""
+
+    __slots__ = ("kind", "device", "at", "old", "new", "status")
+
+    def __init__(self, kind, device, at, old=None, new=None, status=None):
+        self.kind = kind
+        self.device = device
+        self.at = at
+        self.old = old
+        self.new = new
+        self.status = status
+
+    def __repr__(self):
+        return "Event({!r}, {!r}, {!r} -> {!r})".format(self.kind, self.device, self.old, self.new)
+
+
+class StatusTracker(object):
+    """Keep the last known status of a device and derive events from the next."""
+
+    def __init__(self, device=None):
+        self.device = device
+        self.status = None
+
+    # A status without these (e.g. a reply cut short) is ignored.
+    REQUIRED = ("timer.current", "timer.start", "timer.armed", "timer.fired", "timer.locked")
+
+    def update(self, status, at=None):
+        """Take a new status and return the list of events it implies."""
+        if any(name not in status for name in StatusTracker.REQUIRED):
+            return []
+        at = time.time() if at is None else at
+        old, self.status = self.status, status
+        if old is None:
+            return []
+        events = []
+
+        def changed(name, kind, test=lambda before, after: before != after):
+            before, after = old.get(name), status.get(name)
+            if before is not None and after is not None and test(before, after):
+                events.append(Event(kind, self.device, at, before, after, status))
+                return True
+            return False
+
+        if not status["timer.armed"]:
+            changed("timer.fired", REBOOTED, lambda before, after: before and not after)
+        if not changed("timer.fired", FIRED, lambda before, after: after and not before):
+            # Fired and restarted between two polls: only the counter tells.
+            changed("timer.fired.lifetime", FIRED, lambda before, after: after > before)
+        changed("timer.fired.lifetime", COUNTER_RESET, lambda before, after: after < before)
+        changed("timer.armed", ARMED, lambda before, after: after and not before)
+        changed("timer.armed", DISARMED, lambda before, after: before and not after)
+        changed("timer.locked", LOCKED, lambda before, after: after and not before)
+        changed("timer.locked", UNLOCKED, lambda before, after: before and not after)
+        changed("timer.start", TIMER_START_CHANGED)
+        return events
+
+
+class StatusWatcher(object):
+    """Poll the status of a DigiDog and call subscribers with every Event."""
+
+    FAST = 0.5
+    SLOW = 10.0
+    FAST_FOR = 5.0
+
+    def __init__(self, dev, device=None, fast=None, slow=None, fast_for=None):
+        self.dev = dev
+        self.tracker = StatusTracker(device or getattr(dev, "_device", None))
+        self.fast = fast or StatusWatcher.FAST
+        self.slow = slow or StatusWatcher.SLOW
+        self.fast_for = fast_for or StatusWatcher.FAST_FOR
+        self._callbacks = []
+        self._fast_until = 0.0
+
+    @property
+    def status(self):
+        """The last status seen, None before the first poll."""
+        return self.tracker.status
+
+    def subscribe(self, callback):
+        """Call 'callback' with every Event from now on."""
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def nudge(self):
+        """Poll fast for a while, e.g. after sending a command to the device."""
+        self._fast_until = monotonic() + self.fast_for
+
+    def interval(self):
+        """Seconds until the next poll."""
+        return self.fast if monotonic() < self._fast_until else self.slow
+
+    def update(self, status, at=None):
+        """Take a status read elsewhere, dispatch and return its events."""
+        events = self.tracker.update(status, at)
+        if events:
+            self.nudge()
+        for event in events:
+            for callback in list(self._callbacks):
+                callback(event)
+        return events
+
+    def poll(self):
+        """Read the status once, dispatch and return its events."""
+        return self.update(self.dev.get_status())
+
+    def run(self):
+        """Poll until interrupted."""
+        while True:
+            self.poll()
+            time.sleep(self.interval())
+
+
+class AsyncStatusWatcher(StatusWatcher):
+    """StatusWatcher for an AsyncDigiDog. Iterating it with "async for"
+       yields the events and polls while anybody iterates; run() polls for
+       callbacks only. Each iterator buffers up to MAX_PENDING events. With
+       'poll' False, the device is never read; only the statuses given to
+       update() make events."""
+
+    MAX_PENDING = 256
+
+    def __init__(self, dev, poll=True, **kwargs):
+        StatusWatcher.__init__(self, dev, **kwargs)
+        self.poll_device = poll
+        self._task = None
+        self._listeners = []
+        self._wakeup = None
+
+    def nudge(self):
+        StatusWatcher.nudge(self)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def update(self, status, at=None):
+        events = StatusWatcher.update(self, status, at)
+        if events:
+            for queue, ready in self._listeners:
+                queue.extend(events)
+                ready.set()
+        return events
+
+    async def poll(self):
+        try:
+            status = await self.dev.get_status()
+        except asyncio.TimeoutError:
+            # No complete reply, e.g. while the firmware resets the target.
+            return []
+        return self.update(status)
+
+    async def run(self):
+        """Poll until cancelled."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while True:
+            await self.poll()
+            self._wakeup.clear()
+            try:
+                # nudge() cuts a slow wait short.
+                await asyncio.wait_for(self._wakeup.wait(), self.interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def __aiter__(self):
+        listener = (collections.deque(maxlen=AsyncStatusWatcher.MAX_PENDING), asyncio.Event())
+        queue, ready = listener
+        self._listeners.append(listener)
+        if self.poll_device and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self.run())
+        try:
+            while True:
+                while queue:
+                    yield queue.popleft()
+                ready.clear()
+                waiter = asyncio.ensure_future(ready.wait())
+                try:
+                    await asyncio.wait([waiter] + ([self._task] if self._task is not None else []),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if self._task is not None and self._task.done() and not queue:
+                    # Raise the error that ended the polls.
+                    self._task.result()
+        finally:
+            self._listeners.remove(listener)
+            if not self._listeners and self._task is not None:
+                self._task.cancel()
+                self._task = None
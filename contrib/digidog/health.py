@@ -0,0 +1,194 @@
+# Health checks gating the keepalive trigger
+#
+# A HealthGate runs its checks concurrently in a thread pool before a
+# trigger. Each check has a timeout and its result is reused for 'ttl'
+# seconds. While any check fails for longer than 'grace' seconds the
+# trigger is withheld, so the DigiDog recovers the host from a wedged
+# service and not only from a hung kernel.
+#
+# The gate never waits longer than the budget it is given, which the
+# keepalive loops take from the remaining countdown of the device
+# (KeepaliveScheduler.budget()). Checks still running then count with
+# their last result.
+#
+# One gate may serve several devices: evaluate() is serialised, and a
+# caller whose budget runs out while another evaluates gets the verdict
+# of the last evaluation. Only the keepalive loop of the daemon is gated;
+# wdt_start_poll triggers unconditionally.
+
+import concurrent.futures
+import os
+import socket
+import subprocess
+import threading
+import time
+from time import monotonic
+
+
+class Check(object):
+    """A single health check. run() returns (healthy, detail) and may block
+       for up to 'timeout' seconds; it is called from a worker thread."""
+
+    def __init__(self, name, timeout=5.0, ttl=10.0):
+        self.name = name
+        self.timeout = timeout
+        self.ttl = ttl
+
+    def run(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+class CommandCheck(Check):
+    """Healthy if the command exits with status 0 in time."""
+
+    def __init__(self, command, **kwargs):
+        Check.__init__(self, "command {}".format(command), **kwargs)
+        self.command = command
+
+    def run(self):
+        try:
+            result = subprocess.run(self.command, shell=True, timeout=self.timeout,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            return False, "timed out after {}s".format(self.timeout)
+        return result.returncode == 0, "exit status {}".format(result.returncode)
+
+
+class FileAgeCheck(Check):
+    """Healthy if the file was modified within 'max_age' seconds, e.g. a
+       heartbeat file touched by a service."""
+
+    def __init__(self, path, max_age, **kwargs):
+        Check.__init__(self, "file {}".format(path), **kwargs)
+        self.path = path
+        self.max_age = max_age
+
+    def run(self):
+        try:
+            age = time.time() - os.stat(self.path).st_mtime
+        except OSError as e:
+            return False, str(e)
+        return age <= self.max_age, "modified {:.0f}s ago".format(age)
+
+
+class TcpCheck(Check):
+    """Healthy if a TCP connection to the port can be opened."""
+
+    def __init__(self, port, host="127.0.0.1", **kwargs):
+        Check.__init__(self, "tcp {}:{}".format(host, port), **kwargs)
+        self.address = (host, int(port))
+
+    def run(self):
+        try:
+            socket.create_connection(self.address, self.timeout).close()
+        except (OSError, socket.timeout) as e:
+            return False, str(e)
+        return True, "connected"
+
+
+class ProcessCheck(Check):
+    """Healthy if a process is alive. 'process' is the path of a pid file if
+       it starts with '/', otherwise a process name as in /proc/PID/comm."""
+
+    def __init__(self, process, **kwargs):
+        Check.__init__(self, "process {}".format(process), **kwargs)
+        self.process = process
+
+    def run(self):
+        if self.process.startswith("/"):
+            try:
+                with open(self.process) as pid_file:
+                    pid = int(pid_file.read().split()[0])
+                os.kill(pid, 0)
+            except PermissionError:
+                # The process exists but belongs to someone else.
+                return True, "pid {}".format(pid)
+            except (OSError, ValueError, IndexError) as e:
+                return False, str(e) or "empty pid file"
+            return True, "pid {}".format(pid)
+        for pid in os.listdir("/proc"):
+            try:
+                with open("/proc/{}/comm".format(pid)) as comm:
+                    if comm.read().strip() == self.process:
+                        return True, "pid {}".format(pid)
+            except (IOError, OSError):
+                continue
+        return False, "not running"
+
+
+class HealthGate(object):
+    """Decide whether a trigger may be sent from the results of 'checks'.
+       Safe to share between devices and threads."""
+
+    def __init__(self, checks, grace=60.0, workers=None):
+        self.checks = list(checks)
+        self.grace = grace
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or max(1, len(self.checks)))
+        self._running = {}
+        self._results = {}
+        self._failing_since = None
+        self._lock = threading.Lock()
+        self._verdict = (True, [])
+
+    def _submit(self, now):
+        for check in self.checks:
+            if check in self._running:
+                # A hung check is not started again before it returns.
+                continue
+            result = self._results.get(check)
+            if result is None or now - result[0] >= check.ttl:
+                self._running[check] = (now, self._pool.submit(check.run))
+
+    def _collect(self, now):
+        for check, (started, future) in list(self._running.items()):
+            if future.done():
+                del self._running[check]
+                try:
+                    healthy, detail = future.result()
+                except Exception as e:
+                    healthy, detail = False, "{}: {}".format(type(e).__name__, e)
+                self._results[check] = (started, healthy, detail)
+            elif now - started >= check.timeout:
+                self._results[check] = (now, False, "timed out after {}s".format(check.timeout))
+
+    def failures(self):
+        """Return (check, detail) of the checks whose last result was a failure."""
+        return [(check, result[2]) for check, result in self._results.items() if not result[1]]
+
+    def evaluate(self, budget=None):
+        """Run the checks that are due and return (allowed, failures). Waits at
+           most for the checks' timeouts and never longer than 'budget' seconds."""
+        called = monotonic()
+        if not self._lock.acquire(timeout=-1 if budget is None else max(budget, 0.0)):
+            return self._verdict
+        try:
+            self._verdict = self._evaluate(None if budget is None else called + budget)
+            return self._verdict
+        finally:
+            self._lock.release()
+
+    def _evaluate(self, end):
+        now = monotonic()
+        self._submit(now)
+        if self._running:
+            deadline = max(started + check.timeout for check, (started, future) in self._running.items())
+            if end is not None:
+                # The wait for the lock counts against the budget.
+                deadline = min(deadline, end)
+            concurrent.futures.wait([future for started, future in self._running.values()],
+                                    timeout=max(deadline - now, 0.0))
+        now = monotonic()
+        self._collect(now)
+        failures = self.failures()
+        if not failures:
+            self._failing_since = None
+            return True, failures
+        if self._failing_since is None:
+            self._failing_since = now
+        return now - self._failing_since < self.grace, failures
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,287 @@
+# Journal of DigiDog state changes and reset forensics
+#
+# Usage: digidog report [--json] JOURNAL...
+#
+# A Journal is an observer for DigiDog and AsyncDigiDog (like Metrics, see
+# digidog.metrics.Observers to use both) and appends one JSON line per
+# change to its file:
+#
+#   {"host":"web1","journal":1,"t":...}       first line after every start
+#   {"host":"web1","journal":1,"rotated":true,"t":...}  first line after a rotation
+#   {"d":"10000002","s":{"A":true,"L":3},"t":...}   changed values by reply key
+#   {"d":"10000002","r":0.012,"t":...}        round trip time of a trigger
+#   {"d":"10000002","e":"reconnect","t":...}  port opened again after an error
+#   {"d":"10000002","e":"move","p":"/dev/ttyACM1","t":...}  found on another port
+#
+# The status and config values kept are those of JOURNALED; the countdown
+# and the internal watchdog change all the time and are left out. The
+# daemon reads the configuration when it starts serving a device and after
+# its link was lost, so N:, Z: and R: are known for the report. "k" is
+# the calibrated timer rate in ticks per second of the device, if known
+# (see digidog.calibration). The values of all replies of a batch of
+# commands are merged into one line, so the presses of set_timer() make
+# one line rather than one each. Every file starts with the full values. At
+# 'max_bytes' the file is compressed to JOURNAL.1.gz, older ones move on
+# up to JOURNAL.<backups>.gz.
+#
+# report() reads the journals of any number of hosts in parallel and lists
+# every time a DigiDog fired: when it fired (the last trigger plus the
+# timer), the recovery action and its duration from Z: or R:, roughly how
+# long the host was down (until the daemon started again) and percentiles
+# of the trigger round trip times before.
+
+import argparse
+import concurrent.futures
+import glob
+import gzip
+import json
+import os
+import socket
+import sys
+import time
+
+from .client import DigiDog
+from .protocol import FIELDS, parse_lines
+
+JOURNALED = (b"A", b"F", b"J", b"L", b"S", b"T", b"M", b"N", b"Z", b"R")
+NAMES = dict((FIELDS[key][0], key.decode("ascii")) for key in JOURNALED)
+VERSION = 1
+
+
+class Journal(object):
+    """Append status deltas, trigger round trip times and reconnects of
+       devices to a rotated file. 'names' maps ports to the device serials
+       written to the journal, 'ticks_per_second' ports to timer rates."""
+
+    def __init__(self, path, max_bytes=1 << 20, backups=5, names=None, host=None, ticks_per_second=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.names = dict(names or {})
+        self.ticks_per_second = dict(ticks_per_second or {})
+        self.host = host or socket.gethostname()
+        self._file = None
+        self._state = {}
+
+    def _open(self, rotated=False):
+        self._file = open(self.path, "a")
+        header = {"host": self.host, "journal": VERSION}
+        if rotated:
+            header["rotated"] = True
+        self._write(header)
+
+    @staticmethod
+    def _line(record):
+        record["t"] = round(time.time(), 3)
+        return json.dumps(record, separators=(",", ":"), sort_keys=True) + "\n"
+
+    def _write(self, record):
+        if self._file is None:
+            self._open()
+        line = Journal._line(record)
+        if self._file.tell() + len(line) > self.max_bytes and "journal" not in record:
+            self.rotate()
+            line = Journal._line(record)
+        self._file.write(line)
+        self._file.flush()
+
+    def rotate(self):
+        """Compress the current file into the first backup and start a new one."""
+        self.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = "{}.{}.gz".format(self.path, index)
+            if os.path.exists(older):
+                os.rename(older, "{}.{}.gz".format(self.path, index + 1))
+        if self.backups > 0:
+            with open(self.path, "rb") as current, gzip.open("{}.1.gz".format(self.path), "wb") as backup:
+                backup.write(current.read())
+        os.unlink(self.path)
+        # The next values of every device are written in full.
+        self._state = {}
+        self._open(rotated=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _device(self, device):
+        return self.names.get(device, device)
+
+    def observe_exchange(self, device, commands, replies, seconds):
+        """Journal the values of all replies at once, later replies of a
+           batch taking precedence, then the round trip time of a trigger."""
+        results = {}
+        for lines in reversed(replies):
+            for name, value in parse_lines(lines).items():
+                results.setdefault(name, value)
+        self._journal_results(device, results)
+        for command, lines in zip(commands, replies):
+            if command == "R" and lines and lines[-1].startswith(b"P:R"):
+                self._write({"d": self._device(device), "r": round(seconds, 6)})
+                break
+
+    def observe_timeout(self, device, commands):
+        pass
+
+    def observe_reconnect(self, device):
+        self._write({"d": self._device(device), "e": "reconnect"})
+
+    def observe_move(self, device, new_device):
+        for by_port in (self.names, self.ticks_per_second):
+            if device in by_port:
+                by_port[new_device] = by_port.pop(device)
+        self._write({"d": self._device(new_device), "e": "move", "p": new_device})
+
+    def observe_lines(self, device, dropped, malformed):
+        pass
+
+    def observe_results(self, device, results):
+        # Taken from the replies in observe_exchange().
+        pass
+
+    def _journal_results(self, device, results):
+        rate = self.ticks_per_second.get(device)
+        device = self._device(device)
+        state = self._state.setdefault(device, {})
+        delta = {}
+        for name, key in NAMES.items():
+            if name in results and state.get(key) != results[name]:
+                delta[key] = state[key] = results[name]
+        if delta and rate is not None and state.get("k") != rate:
+            delta["k"] = state["k"] = rate
+        if delta:
+            self._write({"d": device, "s": delta})
+
+def journal_files(path):
+    """Return the files of a journal from the oldest to the newest."""
+    backups = []
+    for backup in glob.glob(glob.escape(path) + ".*.gz"):
+        try:
+            backups.append((int(backup[len(path) + 1:-3]), backup))
+        except ValueError:
+            continue
+    files = [backup for index, backup in sorted(backups, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_journal(path):
+    """Yield the records of a journal in the order they were written.
+       Lines that can not be parsed (e.g. cut off by a reset) are skipped."""
+    for name in journal_files(path):
+        with (gzip.open(name, "rt") if name.endswith(".gz") else open(name)) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "t" in record:
+                    yield record
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return the nearest-rank percentiles of 'values' and their maximum."""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = dict(("p{}".format(point), values[min(len(values) - 1, max(0, -(-point * len(values) // 100) - 1))])
+                  for point in points)
+    result["max"] = values[-1]
+    return result
+
+
+def recovery_seconds(state):
+    """Duration of the recovery action of the firmware from Z: or R:."""
+    if state.get("N") == "power" and isinstance(state.get("Z"), dict):
+        return sum(int(value) for value in state["Z"].values()) / 1000.0
+    if "R" in state:
+        return state["R"] / 1000.0
+    return None
+
+
+def analyze(path, samples=100):
+    """Return the fire events found in one journal as dicts."""
+    host = None
+    devices = {}
+    started = None
+    fires = []
+    for record in read_journal(path):
+        if "journal" in record:
+            host = record.get("host", host)
+            if not record.get("rotated"):
+                started = record["t"]
+            continue
+        device = devices.setdefault(record.get("d"), {"state": {}, "triggers": [], "started": None})
+        if "r" in record:
+            device["triggers"] = (device["triggers"] + [(record["t"], record["r"])])[-samples:]
+            device["started"] = None
+            continue
+        delta = record.get("s")
+        if not delta:
+            continue
+        state = device["state"]
+        if device["started"] is None and started is not None and device["triggers"] and started > device["triggers"][-1][0]:
+            device["started"] = started
+        counted = "L" in delta and "L" in state and delta["L"] > state["L"]
+        flagged = delta.get("F") and state.get("F") is False
+        state.update(delta)
+        if not (counted or flagged):
+            continue
+        fire = {"host": host, "device": record.get("d"), "detected": record["t"],
+                "method": state.get("N"), "action_seconds": recovery_seconds(state),
+                "fired_lifetime": state.get("L"), "fired": None, "downtime_seconds": None}
+        if device["triggers"]:
+            last_trigger = device["triggers"][-1][0]
+            if "S" in state:
+                fire["fired"] = last_trigger + state["S"] / state.get("k", DigiDog.TICKS_PER_SECOND)
+                back = device["started"] or record["t"]
+                fire["downtime_seconds"] = max(back - fire["fired"], 0.0)
+            fire["trigger_rtt"] = percentiles([rtt for at, rtt in device["triggers"]])
+            fire["triggers"] = len(device["triggers"])
+        device["triggers"] = []
+        device["started"] = None
+        fires.append(fire)
+    return fires
+
+
+def report(paths, workers=None):
+    """Analyze the journals in parallel and return all fire events by time."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(analyze, paths))
+    fires = [fire for result in results for fire in result]
+    return sorted(fires, key=lambda fire: fire["fired"] or fire["detected"])
+
+
+def describe(fire):
+    at = fire["fired"] or fire["detected"]
+    text = "{} {} DigiDog {} {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(at)), fire["host"],
+                                        fire["device"], "fired" if fire["fired"] else "found fired")
+    if fire["method"]:
+        text += ", {} taking {}s".format(fire["method"], fire["action_seconds"])
+    if fire["downtime_seconds"] is not None:
+        text += ", down about {:.0f}s".format(fire["downtime_seconds"])
+    if fire.get("trigger_rtt"):
+        text += ", trigger rtt " + " ".join("{} {:.1f}ms".format(name, fire["trigger_rtt"][name] * 1000)
+                                            for name in ("p50", "p90", "p99", "max"))
+        text += " over {} triggers".format(fire["triggers"])
+    return text
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="digidog report", description="List the fire events in DigiDog journals.")
+    parser.add_argument("journals", nargs="+", metavar="JOURNAL", help="journal files, e.g. one per host")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per event")
+    args = parser.parse_args(argv[1:])
+    print_report(args.journals, args.json)
+    return 0
+
+
+def print_report(paths, as_json=False):
+    for fire in report(paths):
+        print(json.dumps(fire, sort_keys=True) if as_json else describe(fire))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,212 @@
+# Keepalive metrics of DigiDog clients in the Prometheus text format
+#
+# Pass a Metrics object as 'metrics' to DigiDog or AsyncDigiDog. The
+# collected values can be written to a file for the textfile collector of
+# node_exporter (write_file) or served locally over HTTP (serve).
+
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .client import DigiDog
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets."""
+
+    # Upper bounds in seconds of the round trip time buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or Histogram.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class Metrics(object):
+    """Collect round trip times, timeouts, reconnects, timer headroom and the
+       lifetime fired counter of any number of devices."""
+
+    PREFIX = "digidog_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._timeouts = {}
+        self._reconnects = {}
+        self._dropped = {}
+        self._malformed = {}
+        self._headroom_min = {}
+        self._current = {}
+        self._fired = {}
+        # Calibrated timer rates by device, see digidog.calibration
+        self.ticks_per_second = {}
+
+    def observe_exchange(self, device, commands, replies, seconds):
+        """Record one exchange of 'commands' with their 'replies' (lists of lines).
+           Replies that did not end with their known final line count as timeout."""
+        name = commands[0] if len(commands) == 1 else "batch"
+        with self._lock:
+            self._latency.setdefault((device, name), Histogram()).observe(seconds)
+            for command, lines in zip(commands, replies):
+                end = DigiDog.REPLY_END.get(command)
+                if end is not None and not (lines and lines[-1].startswith(end)):
+                    key = (device, command)
+                    self._timeouts[key] = self._timeouts.get(key, 0) + 1
+
+    def observe_timeout(self, device, commands):
+        """Record an exchange of 'commands' that was given up because their
+           replies did not arrive in time, so there are no replies to pass to
+           observe_exchange() (see AsyncDigiDog)."""
+        with self._lock:
+            for command in commands:
+                if DigiDog.REPLY_END.get(command) is not None:
+                    key = (device, command)
+                    self._timeouts[key] = self._timeouts.get(key, 0) + 1
+
+    def observe_reconnect(self, device):
+        """Record that the port of a device was opened again after an error."""
+        with self._lock:
+            self._reconnects[device] = self._reconnects.get(device, 0) + 1
+
+    def observe_move(self, device, new_device):
+        """Keep the calibrated rate of a device that moved to another port.
+           Its series so far stay with the old port."""
+        with self._lock:
+            if device in self.ticks_per_second:
+                self.ticks_per_second[new_device] = self.ticks_per_second.pop(device)
+
+    def observe_lines(self, device, dropped, malformed):
+        """Record lines of a device dropped as overlong and passed on malformed."""
+        with self._lock:
+            self._dropped[device] = self._dropped.get(device, 0) + dropped
+            self._malformed[device] = self._malformed.get(device, 0) + malformed
+
+    def observe_results(self, device, results):
+        """Pick the timer countdown and fired counter from parsed results."""
+        with self._lock:
+            if results.get("timer.armed") and "timer.current" in results:
+                seconds = results["timer.current"] / self.ticks_per_second.get(device, DigiDog.TICKS_PER_SECOND)
+                self._current[device] = seconds
+                if seconds < self._headroom_min.get(device, seconds + 1):
+                    self._headroom_min[device] = seconds
+            if "timer.fired.lifetime" in results:
+                self._fired[device] = results["timer.fired.lifetime"]
+
+    @staticmethod
+    def _labels(**labels):
+        return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for key, value in sorted(labels.items())) + "}"
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        prefix = Metrics.PREFIX
+        out = []
+        with self._lock:
+            out.append("# HELP {}command_duration_seconds Round trip time of commands.".format(prefix))
+            out.append("# TYPE {}command_duration_seconds histogram".format(prefix))
+            for (device, command), histogram in sorted(self._latency.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    out.append("{}command_duration_seconds_bucket{} {}".format(
+                        prefix, Metrics._labels(device=device, command=command, le=bound), cumulative))
+                labels = Metrics._labels(device=device, command=command)
+                out.append("{}command_duration_seconds_sum{} {}".format(prefix, labels, histogram.sum))
+                out.append("{}command_duration_seconds_count{} {}".format(prefix, labels, histogram.count))
+            simple = (
+                ("command_timeouts_total", "counter", "Replies that did not end in time.",
+                 [(Metrics._labels(device=device, command=command), value)
+                  for (device, command), value in sorted(self._timeouts.items())]),
+                ("reconnects_total", "counter", "Ports opened again after an error.", self._by_device(self._reconnects)),
+                ("lines_dropped_total", "counter", "Overlong lines dropped from replies.", self._by_device(self._dropped)),
+                ("lines_malformed_total", "counter", "Reply lines not shaped like K:value.", self._by_device(self._malformed)),
+                ("timer_remaining_seconds", "gauge", "Last observed countdown of an armed timer.", self._by_device(self._current)),
+                ("timer_headroom_min_seconds", "gauge", "Lowest observed countdown of an armed timer.", self._by_device(self._headroom_min)),
+                ("timer_fired_lifetime", "gauge", "Times the watchdog fired since the last EEPROM clear (L:).", self._by_device(self._fired)),
+            )
+            for name, kind, text, samples in simple:
+                out.append("# HELP {}{} {}".format(prefix, name, text))
+                out.append("# TYPE {}{} {}".format(prefix, name, kind))
+                for labels, value in samples:
+                    out.append("{}{}{} {}".format(prefix, name, labels, value))
+        return "\n".join(out) + "\n"
+
+    @staticmethod
+    def _by_device(values):
+        return [(Metrics._labels(device=device), value) for device, value in sorted(values.items())]
+
+    def write_file(self, path):
+        """Write the metrics to 'path', replacing it at once so readers never see
+           a partial file."""
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temp, path)
+
+    def serve(self, port, address="127.0.0.1"):
+        """Serve the metrics over HTTP from a background thread and return the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class Observers(object):
+    """Pass the observations of a device to several observers, e.g. Metrics
+       and a digidog.journal.Journal, as DigiDog takes only one."""
+
+    def __init__(self, *observers):
+        self.observers = list(observers)
+
+    def observe_exchange(self, device, commands, replies, seconds):
+        for observer in self.observers:
+            observer.observe_exchange(device, commands, replies, seconds)
+
+    def observe_timeout(self, device, commands):
+        for observer in self.observers:
+            observer.observe_timeout(device, commands)
+
+    def observe_reconnect(self, device):
+        for observer in self.observers:
+            observer.observe_reconnect(device)
+
+    def observe_move(self, device, new_device):
+        for observer in self.observers:
+            observer.observe_move(device, new_device)
+
+    def observe_lines(self, device, dropped, malformed):
+        for observer in self.observers:
+            observer.observe_lines(device, dropped, malformed)
+
+    def observe_results(self, device, results):
+        for observer in self.observers:
+            observer.observe_results(device, results)
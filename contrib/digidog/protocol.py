@@ -0,0 +1,158 @@
+# Reply parsing of the DigiDog serial protocol (SLCPv1)
+
+
+class CommandBlocked(NotImplementedError):
+    pass
+
+class VersionMismatch(NotImplementedError):
+    pass
+
+class CommandNotSensibleInThisState(NotImplementedError):
+    pass
+
+class ConfigMismatch(ValueError):
+    pass
+
+def _text(value):
+    return value.decode("ascii", "replace")
+
+
+def _flag(value):
+    return bool(int(value))
+
+
+def _recovery_method(value):
+    return "power" if int(value) else "reset"
+
+
+def _level(value):
+    return "HIGH" if int(value) else "LOW"
+
+
+def _pinout(value):
+    reset, power, led = _text(value).split(",")
+    return {"reset": reset, "power": power, "led": led}
+
+
+def _output_levels(value):
+    reset, power = value.split(b" ")
+    reset_on, reset_off = reset.split(b",")
+    power_on, power_off = power.split(b",")
+    return {
+        "reset": {"on": _level(reset_on), "off": _level(reset_off)},
+        "power": {"on": _level(power_on), "off": _level(power_off)},
+        }
+
+
+def _power_timings(value):
+    press1, pause, press2 = _text(value).split(",")
+    return {"press1": press1, "pause": pause, "press2": press2}
+
+
+# Key of a reply line -> (name, conversion of the value, listed). Values of
+# listed keys are collected as lists of strings in the results of
+# DigiDog.command(), the others are converted.
+FIELDS = {
+    b"A": ("timer.armed", _flag, False),
+    b"C": ("timer.current", int, False),
+    b"F": ("timer.fired", _flag, False),
+    b"H": ("device.pinout", _pinout, False),
+    b"I": ("device.output-levels", _output_levels, False),
+    b"J": ("timer.locked", _flag, False),
+    b"K": ("device.internal-watchdog", int, False),
+    b"L": ("timer.fired.lifetime", int, False),
+    b"M": ("target.recovery-method.firmware", _recovery_method, False),
+    b"N": ("target.recovery-method", _recovery_method, False),
+    b"O": ("device.serial", _text, True),
+    b"P": ("command.executed", _text, True),
+    b"Q": ("command.blocked", _text, True),
+    b"R": ("target.reset-timings", int, False),
+    b"S": ("timer.start", int, False),
+    b"T": ("timer.start.firmware", int, False),
+    b"U": ("device.unit-id", int, True),
+    b"V": ("device.version", int, True),
+    b"W": ("debug.method", _text, True),
+    b"X": ("command.not-implemented", int, True),
+    b"Z": ("target.power-timings", _power_timings, False),
+}
+
+
+def parse_lines(lines):
+    """Parse reply lines (bytes) into a dict of results by their names in
+       FIELDS. Listed values are lists of strings, others are converted; the
+       first value of a key wins. Lines with other keys or values that can
+       not be converted are kept as strings under "unknown"."""
+    parsed = {}
+    for line in lines:
+        key, sep, value = line.partition(b":")
+        value = value.strip()
+        field = FIELDS.get(key) if sep else None
+        if field is not None:
+            name, convert, listed = field
+            if listed:
+                parsed.setdefault(name, []).append(_text(value))
+                continue
+            if name in parsed:
+                continue
+            try:
+                parsed[name] = convert(value)
+                continue
+            except ValueError:
+                pass
+        if not sep:
+            key, value = b"unknown", line.strip()
+        unknown = parsed.setdefault("unknown", {})
+        unknown.setdefault(_text(key), []).append(_text(value))
+    return parsed
+
+
+class LineSplitter(object):
+    """Split the byte stream of a device into lines with bounded memory.
+       feed() yields every complete line without its line end, skipping
+       empty ones. A line longer than MAX_LINE can not be a reply of the
+       firmware (e.g. line noise or a device printing in a loop); it is
+       dropped up to the next line end and counted in 'dropped'. Lines that
+       are not shaped like "K:value" are passed on and counted in
+       'malformed', parse_lines() files them under "unknown"."""
+
+    # The longest line of the firmware is about 20 bytes.
+    MAX_LINE = 64
+
+    def __init__(self, max_line=None):
+        self.max_line = max_line or LineSplitter.MAX_LINE
+        self.dropped = 0
+        self.malformed = 0
+        self._buffer = bytearray()
+        self._overrun = False
+
+    def feed(self, data):
+        """Add 'data' and yield the lines completed by it."""
+        buffer = self._buffer
+        buffer.extend(data)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if self._overrun or len(line) > self.max_line:
+                self._overrun = False
+                self.dropped += 1
+            elif line:
+                if line[1:2] != b":":
+                    self.malformed += 1
+                yield line
+        del buffer[:start]
+        if len(buffer) > self.max_line:
+            # Keep nothing of an overlong line, only remember to drop its end.
+            del buffer[:]
+            self._overrun = True
+
+    def flush(self):
+        """Return the incomplete last line (or b"") and forget it."""
+        line = b"" if self._overrun else bytes(self._buffer).rstrip(b"\r")
+        del self._buffer[:]
+        self._overrun = False
+        return line
+
@@ -0,0 +1,123 @@
+# Recovery of a hung link to a DigiDog
+#
+# The USB stack of the device (DigiCDC) is known to hang; the firmware
+# reruns setup() when it was not spoken to for INTERNAL_WATCHDOG_START
+# loops and reinitialises the stack on '!'. When an exchange times out or
+# the port fails, Recovery escalates through
+#
+#   reopen            close and open the port, ask for the status
+#   reinit-usb        send '!', then reopen
+#   wait-enumeration  poll /dev and /sys until the port is back and answers
+#   rediscover        probe the other ports for the device's serial
+#
+# until the device answers again. The whole recovery is bounded by the
+# budget the caller takes from the last countdown seen (see
+# KeepaliveScheduler.budget()), so there is still time for the trigger.
+
+import asyncio
+import os
+from time import monotonic
+
+from .aio import probe
+
+
+class Recovery(object):
+    """Escalating recovery of the link to an AsyncDigiDog. 'ports' is called
+       to get the ports to search when the device moved."""
+
+    REOPEN = "reopen"
+    REINIT_USB = "reinit-usb"
+    WAIT_ENUMERATION = "wait-enumeration"
+    REDISCOVER = "rediscover"
+    # Step -> longest time it may take in seconds
+    STEPS = ((REOPEN, 2.0), (REINIT_USB, 3.0), (WAIT_ENUMERATION, 10.0), (REDISCOVER, 10.0))
+    # Interval of polling /dev and /sys
+    POLL = 0.1
+
+    def __init__(self, ports=None, probe_timeout=0.5):
+        self.ports = ports or (lambda: [])
+        self.probe_timeout = probe_timeout
+
+    @staticmethod
+    def port_present(port):
+        """True if the port exists in /dev and, for ttys sysfs knows (not
+           pseudo-terminals), in /sys as well."""
+        if not os.path.exists(port):
+            return False
+        node = os.path.realpath(port)
+        sysfs = "/sys/class/tty"
+        if os.path.dirname(node) == "/dev" and os.path.isdir(sysfs):
+            return os.path.exists(os.path.join(sysfs, os.path.basename(node)))
+        return True
+
+    @staticmethod
+    async def _answers(dev):
+        """True if the device answers 'V' and 'S' with a complete status."""
+        dev.close()
+        dev.open()
+        # Not get_status(): a version read during the hang would be cached empty.
+        version, status = await dev.batch(["V", "S"])
+        return "device.version" in version and "timer.current" in status
+
+    async def _reopen(self, dev, device_serial, exclude):
+        return await Recovery._answers(dev)
+
+    async def _reinit_usb(self, dev, device_serial, exclude):
+        try:
+            await dev.reinit_usb()
+        except (asyncio.TimeoutError, IOError, OSError):
+            # The port is likely gone already.
+            pass
+        dev.close()
+        # Give the device a moment to drop off the bus.
+        await asyncio.sleep(0.5)
+        return await Recovery._answers(dev)
+
+    async def _wait_enumeration(self, dev, device_serial, exclude):
+        while True:
+            if Recovery.port_present(dev.device):
+                try:
+                    if await Recovery._answers(dev):
+                        return True
+                except (asyncio.TimeoutError, IOError, OSError):
+                    pass
+            await asyncio.sleep(Recovery.POLL)
+
+    async def _rediscover(self, dev, device_serial, exclude):
+        while True:
+            for port in self.ports():
+                if port == dev.device or port in exclude or not Recovery.port_present(port):
+                    continue
+                found = await probe(port, self.probe_timeout)
+                if found is None:
+                    continue
+                found_serial = (await found.version_info())["device.serial"][-1].upper()
+                found.close()
+                if found_serial == device_serial:
+                    print("{}: DigiDog {} moved to {}".format(dev.device, device_serial, port))
+                    dev.move(port)
+                    if await Recovery._answers(dev):
+                        return True
+            await asyncio.sleep(Recovery.POLL)
+
+    async def recover(self, dev, device_serial, budget, exclude=()):
+        """Try the steps in turn until the device answers, within 'budget'
+           seconds. 'exclude' lists ports of other devices not to probe.
+           Return the step that succeeded, None if all failed."""
+        end = monotonic() + budget
+        steps = {Recovery.REOPEN: self._reopen, Recovery.REINIT_USB: self._reinit_usb,
+                 Recovery.WAIT_ENUMERATION: self._wait_enumeration, Recovery.REDISCOVER: self._rediscover}
+        for step, limit in Recovery.STEPS:
+            left = end - monotonic()
+            if left <= 0:
+                print("{}: No time left to recover the link".format(dev.device))
+                return None
+            if step == Recovery.REDISCOVER and device_serial is None:
+                continue
+            print("{}: Recovering the link: {}".format(dev.device, step))
+            try:
+                if await asyncio.wait_for(steps[step](dev, device_serial, exclude), min(limit, left)):
+                    return step
+            except (asyncio.TimeoutError, IOError, OSError) as e:
+                print("{}: {} failed: {}".format(dev.device, step, str(e) or type(e).__name__))
+        return None
@@ -0,0 +1,49 @@
+# Tests of the asyncio client against the emulator
+
+import asyncio
+
+import pytest
+
+from digidog.client import LineCounter
+from digidog.emulator import EmulatorHost
+
+pytest.importorskip("serial")
+
+
+class FlushCounter(object):
+    """Transport counting the flushes of the OS input buffer."""
+
+    def __init__(self):
+        self.flushes = 0
+
+    def __call__(self, device):
+        from digidog.aio import AsyncSerialPort
+        port = AsyncSerialPort.open_serial(device)
+        reset_input_buffer = port.reset_input_buffer
+
+        def counted():
+            self.flushes += 1
+            reset_input_buffer()
+
+        port.reset_input_buffer = counted
+        return port
+
+
+def test_exchanges_flush_the_os_input_buffer():
+    from digidog.aio import AsyncDigiDog
+
+    transport = FlushCounter()
+
+    async def run(port):
+        dev = AsyncDigiDog(port, transport=transport)
+        async with dev:
+            flushes = transport.flushes
+            status = await dev.command("S")
+            assert transport.flushes == flushes + 1
+        return dev, status
+
+    with EmulatorHost() as host:
+        dev, status = asyncio.run(run(host.add().port))
+    assert "timer.current" in status
+    assert isinstance(dev, LineCounter)
+    assert (dev.dropped_lines, dev.malformed_lines) == (0, 0)
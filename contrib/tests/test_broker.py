@@ -0,0 +1,118 @@
+# Tests of the control socket of the daemon
+
+import asyncio
+import errno
+import os
+import socket
+import stat
+
+import pytest
+
+from digidog.broker import Broker, request, subscribe
+from digidog.emulator import EmulatorHost
+
+pytest.importorskip("serial")
+
+
+def test_keepalive_reads_fill_the_cache():
+    from digidog.aio import AsyncDigiDog
+
+    async def run(port):
+        dev = AsyncDigiDog(port)
+        broker = Broker({"10000002": dev}, max_age=10.0)
+        dev.metrics = broker
+        async with dev:
+            # As the keepalive loop of the supervisor does
+            await dev.get_status()
+            at, results = broker._snapshots[("10000002", "S")]
+            reply = await broker.handle({"command": "status"})
+            assert reply["results"] is results
+            await dev.command("R")
+            assert ("10000002", "S") not in broker._snapshots
+
+    with EmulatorHost() as host:
+        asyncio.run(run(host.add().port))
+
+
+def serve(path, check, mode=0o600):
+    async def run():
+        broker = Broker({})
+        task = asyncio.ensure_future(broker.serve(path, mode))
+        await asyncio.sleep(0.1)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, check)
+        finally:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(run())
+
+
+def test_socket_is_created_with_its_mode(tmp_path):
+    path = str(tmp_path / "sock")
+
+    def check():
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert request(path, {"command": "status"})["ok"] is False
+
+    serve(path, check)
+    assert not os.path.exists(path)
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / "sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    serve(path, lambda: request(path, {"command": "status"}))
+
+
+def test_other_files_and_live_sockets_are_left_alone(tmp_path):
+    path = str(tmp_path / "sock")
+    with open(path, "w") as other:
+        other.write("data")
+    with pytest.raises(OSError) as error:
+        asyncio.run(Broker({}).serve(path))
+    assert error.value.errno == errno.EEXIST
+    os.unlink(path)
+
+    listening = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listening.bind(path)
+    listening.listen(1)
+    try:
+        with pytest.raises(OSError) as error:
+            asyncio.run(Broker({}).serve(path))
+        assert error.value.errno == errno.EADDRINUSE
+    finally:
+        listening.close()
+
+
+def test_subscribers_get_the_events_of_the_keepalive_loop(tmp_path):
+    from digidog.aio import AsyncDigiDog, AsyncSupervisor
+
+    path = str(tmp_path / "sock")
+
+    def first_fired():
+        for event in subscribe(path):
+            if event["event"] == "fired":
+                return event
+
+    async def run(port):
+        supervisor = AsyncSupervisor(timer=100)
+        # Triggered less often than the timer of about a second lasts.
+        dev = supervisor.add(AsyncDigiDog(port), interval=1.5)
+        broker = Broker({"10000002": dev}, supervisor)
+        tasks = [asyncio.ensure_future(supervisor.run()), asyncio.ensure_future(broker.serve(path))]
+        await asyncio.sleep(0.2)
+        try:
+            return await asyncio.wait_for(asyncio.get_event_loop().run_in_executor(None, first_fired), 10.0)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    with EmulatorHost() as host:
+        event = asyncio.run(run(host.add(tick=0.01).port))
+    assert event["device"] == "10000002"
+    assert (event["old"], event["new"]) == (False, True)
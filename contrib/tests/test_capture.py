@@ -0,0 +1,29 @@
+# Tests of recording the traffic of the asyncio client
+
+import asyncio
+
+import pytest
+
+from digidog.capture import READ, WRITE, CaptureLog, Recorder
+from digidog.emulator import EmulatorHost
+
+pytest.importorskip("serial")
+
+
+def test_async_client_is_recorded(tmp_path):
+    from digidog.aio import AsyncDigiDog, AsyncSerialPort
+
+    log = CaptureLog()
+
+    async def status(port):
+        async with AsyncDigiDog(port, transport=Recorder(log, AsyncSerialPort.open_serial)) as dev:
+            return await dev.get_status()
+
+    with EmulatorHost() as host:
+        emulator = host.add()
+        assert "timer.current" in asyncio.run(status(emulator.port))
+    path = str(tmp_path / "capture")
+    log.save(path)
+    records = list(CaptureLog.load(path))
+    assert [data for at, direction, data in records if direction == WRITE] == [b"V", b"S"]
+    assert b"#:3" in b"".join(data for at, direction, data in records if direction == READ)
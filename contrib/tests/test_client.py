@@ -0,0 +1,55 @@
+# Tests of the synchronous client against the firmware model and the emulator
+
+import time
+
+import pytest
+
+from digidog.bench import LoopbackDigiDog
+from digidog.client import DigiDog
+from digidog.emulator import Emulator, EmulatorHost
+
+
+def test_apply_config_writes_the_eeprom_only_on_changes():
+    desired = {"timer.start": 1500, "target.recovery-method": "power"}
+    with LoopbackDigiDog() as dev:
+        writes = dev.firmware.eeprom_writes
+        config = dev.apply_config(desired)
+        assert config["timer.start"] == 1500
+        assert config["target.recovery-method"] == "power"
+        assert dev.firmware.eeprom_writes == writes + 1
+        dev.apply_config(desired)
+        assert dev.firmware.eeprom_writes == writes + 1
+        dev.apply_config(desired, persist=False)
+        assert dev.firmware.eeprom_writes == writes + 1
+
+
+def test_apply_config_over_many_chunks():
+    with LoopbackDigiDog() as dev:
+        writes = dev.firmware.eeprom_writes
+        assert dev.apply_config({"timer.start": 20000})["timer.start"] == 20000
+        assert dev.firmware.eeprom_writes == writes + 1
+
+
+def test_emulator_takes_one_input_buffer_per_pass():
+    emulator = Emulator(tick=0.1)
+    try:
+        timer = emulator.firmware.eeprom["timer_start"]
+        emulator._input.extend(b"+" * 40)
+        emulator.step(emulator._next_tick)
+        assert emulator.firmware.eeprom["timer_start"] == timer + Emulator.INPUT_BUFFER * DigiDog.TIMER_SET_STEP
+        assert len(emulator._input) == 40 - Emulator.INPUT_BUFFER
+    finally:
+        emulator.close()
+
+
+def test_set_timer_in_chunks_over_the_emulator():
+    pytest.importorskip("serial")
+    with EmulatorHost() as host:
+        emulator = host.add()
+        with DigiDog(emulator.port) as dev:
+            started = time.monotonic()
+            dev.set_timer(10000)
+            # 88 presses take three passes at least.
+            assert time.monotonic() - started >= 0.2
+            assert dev.get_timer_start() == 10000
+            assert emulator.firmware.eeprom["timer_start"] == 10000
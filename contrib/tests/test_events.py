@@ -0,0 +1,49 @@
+# Tests of the change events derived from statuses
+
+from digidog.bench import LoopbackDigiDog
+from digidog.events import ARMED, COUNTER_RESET, DISARMED, FIRED, REBOOTED, TIMER_START_CHANGED, StatusTracker
+
+
+def kinds(events):
+    return [event.kind for event in events]
+
+
+def test_tracker_sees_arming_firing_and_timer_changes():
+    tracker = StatusTracker("10000002")
+    with LoopbackDigiDog() as dev:
+        assert tracker.update(dev.get_status()) == []
+        events = tracker.update(dev.arm())
+        assert kinds(events) == [ARMED]
+        assert (events[0].old, events[0].new, events[0].device) == (False, True, "10000002")
+        dev.set_timer(1500)
+        assert kinds(tracker.update(dev.get_status())) == [TIMER_START_CHANGED]
+        dev.firmware.timer = 0
+        dev.firmware.tick()
+        assert kinds(tracker.update(dev.get_status())) == [FIRED, DISARMED]
+
+
+def test_tracker_sees_a_fire_between_two_polls_and_reboots():
+    tracker = StatusTracker()
+    with LoopbackDigiDog() as dev:
+        tracker.update(dev.arm())
+        dev.firmware.timer = 0
+        dev.firmware.tick()
+        # Armed again before the next poll: only the counter tells.
+        assert kinds(tracker.update(dev.arm())) == [FIRED]
+        dev.firmware.timer = 0
+        dev.firmware.tick()
+        tracker.update(dev.get_status())
+        dev.firmware.setup()
+        assert kinds(tracker.update(dev.get_status())) == [REBOOTED]
+
+
+def test_tracker_ignores_incomplete_statuses():
+    tracker = StatusTracker()
+    with LoopbackDigiDog() as dev:
+        status = dev.get_status()
+    assert tracker.update(status) == []
+    assert tracker.update({"timer.current": 3}) == []
+    assert tracker.status is status
+    counted = dict(status, **{"timer.fired.lifetime": status["timer.fired.lifetime"] + 5})
+    assert kinds(tracker.update(counted)) == [FIRED]
+    assert kinds(tracker.update(status)) == [COUNTER_RESET]
@@ -0,0 +1,46 @@
+# Tests of the health gate shared by the devices of the daemon
+
+import configparser
+import threading
+import time
+
+from digidog.daemon import DEFAULTS, device_settings
+from digidog.health import Check, HealthGate
+
+
+class SlowCheck(Check):
+    def __init__(self, seconds):
+        Check.__init__(self, "slow", timeout=10.0, ttl=0.0)
+        self.seconds = seconds
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        time.sleep(self.seconds)
+        return True, "done"
+
+
+def test_devices_with_the_same_checks_share_a_gate():
+    config = configparser.ConfigParser(defaults=DEFAULTS)
+    config.read_string("[DEFAULT]\ncheck-tcp = 80\n[10000002]\n[10000003]\n[10000004]\ncheck-tcp = 443\n")
+    gates = {}
+    health = [device_settings(config, section, gates=gates)[3] for section in config.sections()]
+    assert health[0] is health[1]
+    assert health[2] is not health[0]
+    assert len(gates) == 2
+
+
+def test_callers_out_of_budget_get_the_last_verdict():
+    check = SlowCheck(0.5)
+    gate = HealthGate([check])
+    try:
+        first = threading.Thread(target=gate.evaluate)
+        first.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        assert gate.evaluate(budget=0.1) == (True, [])
+        assert time.monotonic() - started < 0.3
+        first.join()
+        assert check.runs == 1
+    finally:
+        gate.close()
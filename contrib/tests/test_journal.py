@@ -0,0 +1,94 @@
+# Tests of the journal and the fire report, driven by the emulator
+
+import asyncio
+
+import pytest
+
+from digidog.bench import LoopbackDigiDog
+from digidog.emulator import EmulatorHost
+from digidog.journal import Journal, analyze, read_journal
+
+
+def fire(firmware):
+    """Let the countdown of an armed Firmware run out."""
+    firmware.timer = 0
+    firmware.tick()
+
+
+def test_report_shows_reset_method_and_duration(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path, names={"loopback": "10000002"})
+    with LoopbackDigiDog(metrics=journal) as dev:
+        dev.get_config()
+        dev.arm()
+        dev.trigger()
+        fire(dev.firmware)
+        dev.get_status()
+    journal.close()
+    fires = analyze(path)
+    assert len(fires) == 1
+    assert fires[0]["device"] == "10000002"
+    assert fires[0]["method"] == "reset"
+    assert fires[0]["action_seconds"] == 1.0
+    assert fires[0]["fired_lifetime"] == 1
+    assert fires[0]["fired"] is not None
+
+
+def test_report_shows_power_cycle_duration(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    with LoopbackDigiDog(metrics=journal) as dev:
+        dev.command("M")
+        dev.get_config()
+        dev.arm()
+        dev.trigger()
+        fire(dev.firmware)
+        dev.get_status()
+    journal.close()
+    fires = analyze(path)
+    assert [(fire["method"], fire["action_seconds"]) for fire in fires] == [("power", 8.0)]
+
+
+def test_batch_is_one_line_with_all_replies(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    with LoopbackDigiDog(metrics=journal) as dev:
+        dev.batch(["V", "C"])
+        dev.arm()
+        dev.batch(["S", "R"])
+        dev.set_timer(1500)
+        dev.batch(["-", "-", "S"])
+    journal.close()
+    records = [record for record in read_journal(path) if "journal" not in record]
+    assert records[0]["s"]["N"] == "reset"
+    assert records[0]["s"]["Z"] == {"press1": "5000", "pause": "2000", "press2": "1000"}
+    assert records[1]["s"]["A"] is True
+    assert "r" in records[2]
+    assert [record["s"]["S"] for record in records[3:]] == [1500, 1300]
+
+
+def test_daemon_journal_reports_method(tmp_path):
+    pytest.importorskip("serial")
+    from digidog.aio import AsyncDigiDog, AsyncSupervisor
+
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+
+    async def serve(port):
+        supervisor = AsyncSupervisor(timer=100)
+        # Triggered less often than the timer of about a second lasts.
+        supervisor.add(AsyncDigiDog(port, metrics=journal), interval=1.5)
+        task = asyncio.ensure_future(supervisor.run())
+        await asyncio.sleep(4.0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with EmulatorHost() as host:
+        emulator = host.add(tick=0.01)
+        asyncio.run(serve(emulator.port))
+    journal.close()
+    fires = analyze(path)
+    assert fires
+    assert fires[0]["method"] == "reset"
+    assert fires[0]["action_seconds"] == 1.0
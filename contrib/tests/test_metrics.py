@@ -0,0 +1,39 @@
+# Tests of the keepalive metrics against the emulator
+
+import asyncio
+
+import pytest
+
+from digidog.client import DigiDog
+from digidog.emulator import EmulatorHost
+from digidog.metrics import Metrics
+
+pytest.importorskip("serial")
+
+
+def timeouts(metrics, device):
+    return metrics._timeouts.get((device, "S"), 0)
+
+
+def test_sync_and_async_count_the_same_timeout():
+    from digidog.aio import AsyncDigiDog
+
+    async def status(dev):
+        async with dev:
+            with pytest.raises(asyncio.TimeoutError):
+                await dev.command("S")
+
+    with EmulatorHost() as host:
+        emulator = host.add()
+        metrics = Metrics()
+        with DigiDog(emulator.port, metrics=metrics) as dev:
+            emulator.stall(1.0)
+            dev.command("S")
+        assert timeouts(metrics, emulator.port) == 1
+
+        metrics = Metrics()
+        dev = AsyncDigiDog(emulator.port, metrics=metrics)
+        emulator.stall(3.0)
+        asyncio.run(status(dev))
+        assert timeouts(metrics, emulator.port) == 1
+        assert 'digidog_command_timeouts_total{command="S",device="' in metrics.render()
@@ -0,0 +1,56 @@
+# Tests of the reply parsing and the timer planning
+
+from digidog.bench import recorded_stream
+from digidog.client import DigiDog
+from digidog.protocol import LineSplitter, parse_lines
+
+
+def test_plan_timer_follows_steps_and_limits():
+    assert DigiDog.plan_timer(1200, 1200) == ("", 1200)
+    assert DigiDog.plan_timer(1200, 1450) == ("+++", 1500)
+    assert DigiDog.plan_timer(1200, 950) == ("--", 1000)
+    assert DigiDog.plan_timer(1200, 50) == ("-" * 11, 100)
+    assert DigiDog.plan_timer(64950, 65535) == ("+", 65000)
+
+
+def test_timer_chunks_end_where_the_plan_ends():
+    presses, expected = DigiDog.plan_timer(100, 65000)
+    chunks = DigiDog.timer_chunks(100, presses)
+    assert "".join(chunk for chunk, timer in chunks) == presses
+    assert all(len(chunk) <= DigiDog.TIMER_CHUNK for chunk, timer in chunks)
+    assert chunks[0][1] == 100 + DigiDog.TIMER_CHUNK * DigiDog.TIMER_SET_STEP
+    assert chunks[-1][1] == expected
+    assert DigiDog.timer_chunks(150, "--") == [("--", 100)]
+
+
+def test_line_splitter_matches_splitlines_in_any_pieces():
+    stream = recorded_stream()
+    expected = [line for line in stream.splitlines() if line]
+    for size in (1, 7, 64, len(stream)):
+        splitter = LineSplitter()
+        lines = []
+        for start in range(0, len(stream), size):
+            lines.extend(splitter.feed(stream[start:start + size]))
+        assert lines == expected
+        assert splitter.flush() == b""
+        assert (splitter.dropped, splitter.malformed) == (0, 0)
+
+
+def test_line_splitter_drops_overlong_and_counts_malformed_lines():
+    splitter = LineSplitter()
+    lines = list(splitter.feed(b"S:1200\r\n" + b"x" * 100))
+    lines += list(splitter.feed(b"y" * 100 + b"\r\nnoise\r\nA:1\r\nC:11"))
+    assert lines == [b"S:1200", b"noise", b"A:1"]
+    assert (splitter.dropped, splitter.malformed) == (1, 1)
+    assert splitter.flush() == b"C:11"
+
+
+def test_parse_lines_converts_lists_and_keeps_unknown():
+    results = parse_lines([b"N:1", b"Z:5000,2000,1000", b"P:R", b"P:X", b"S:12", b"S:13",
+                           b"A:yes", b"Y:1", b"noise"])
+    assert results["target.recovery-method"] == "power"
+    assert results["target.power-timings"] == {"press1": "5000", "pause": "2000", "press2": "1000"}
+    assert results["command.executed"] == ["R", "X"]
+    assert results["timer.start"] == 12
+    assert results["unknown"] == {"A": ["yes"], "Y": ["1"], "unknown": ["noise"]}
+    assert parse_lines([b"N:0"])["target.recovery-method"] == "reset"